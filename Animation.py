@@ -0,0 +1,119 @@
+# Effects, which are rendered locally on the LED node instead of being streamed over MQTT
+#
+# Every effect renders a frame for a given time since it has been started, directly into an
+# (LED count, 3) uint8 frame buffer. The renderer calls render on its own clock, so an effect
+# only needs to be sent once as a short command. Colours and brightness curves are precomputed
+# into tables, so rendering a frame is just a few table lookups.
+
+import colorsys
+import numpy as np
+
+# Colour wheel with 256 steps, used by the rainbow effect
+HUE_TABLE = np.array([[int(round(c * 255)) for c in colorsys.hsv_to_rgb(i / 256, 1, 1)] for i in range(256)], dtype=np.uint8)
+
+# One period of a smooth rise and fall from 0 to 1 and back, used by the breathing effect
+BREATH_TABLE = (1 - np.cos(2 * np.pi * np.arange(256) / 256)) / 2
+
+# Abstract class, defining an effect
+class Effect:
+    # Seconds until the effect has finished, None for endless effects
+    duration = None
+
+    # Called once with the currently shown frame, before the first render
+    def start(self, frame):
+        pass
+
+    # Renders the effect at t seconds after its start into frame
+    def render(self, t, frame):
+        pass
+
+    def finished(self, t):
+        return self.duration is not None and t >= self.duration
+
+# Sets all LEDs to a single colour
+class StaticColour(Effect):
+    duration = 0
+    colour = None
+
+    def render(self, t, frame):
+        frame[:] = self.colour
+
+    def __init__(self, colour):
+        self.colour = np.asarray(colour, dtype=np.uint8)
+
+# Wipes a colour across the strip, one LED after another
+class Wipe(Effect):
+    colour = None
+    start_frame = None
+
+    def start(self, frame):
+        self.start_frame = frame.copy()
+
+    def render(self, t, frame):
+        n = len(frame)
+        k = n if self.duration <= 0 else min(n, int(n * t / self.duration))
+        frame[:k] = self.colour
+        frame[k:] = self.start_frame[k:]
+
+    def __init__(self, colour, duration):
+        self.colour = np.asarray(colour, dtype=np.uint8)
+        self.duration = duration
+
+# Fades all LEDs from their current colour to a single colour
+class Fade(Effect):
+    colour = None
+    start_frame = None
+    diff = None
+    blend = None
+
+    def start(self, frame):
+        self.start_frame = frame.astype(np.float32)
+        self.diff = self.colour - self.start_frame
+        self.blend = np.zeros(frame.shape, dtype=np.float32)
+
+    def render(self, t, frame):
+        alpha = 1 if self.duration <= 0 else min(1, t / self.duration)
+        np.multiply(self.diff, alpha, out=self.blend)
+        self.blend += self.start_frame
+        np.copyto(frame, self.blend, casting='unsafe')
+
+    def __init__(self, colour, duration):
+        self.colour = np.asarray(colour, dtype=np.float32)
+        self.duration = duration
+
+# Colour wheel moving along the strip
+class Rainbow(Effect):
+    # Rotations of the colour wheel per second
+    speed = 0
+    # Number of full colour wheels across the strip
+    spread = 1
+    offsets = None
+    index = None
+
+    def start(self, frame):
+        n = len(frame)
+        self.offsets = (np.arange(n) * 256 * self.spread // n).astype(np.intp)
+        self.index = np.zeros(n, dtype=np.intp)
+
+    def render(self, t, frame):
+        np.add(self.offsets, int(t * self.speed * 256), out=self.index)
+        np.bitwise_and(self.index, 255, out=self.index)
+        np.take(HUE_TABLE, self.index, axis=0, out=frame)
+
+    def __init__(self, speed = 0.2, spread = 1):
+        self.speed = speed
+        self.spread = spread
+
+# Single colour, slowly getting brighter and darker
+class Breathing(Effect):
+    # Seconds of one breath
+    period = 1
+    # Colour at each step of BREATH_TABLE
+    levels = None
+
+    def render(self, t, frame):
+        frame[:] = self.levels[int(t / self.period * 256) & 255]
+
+    def __init__(self, colour, period = 4):
+        self.period = period
+        self.levels = np.round(np.outer(BREATH_TABLE, colour)).astype(np.uint8)
@@ -0,0 +1,234 @@
+# Sources of audio samples for the SoundAnalyzer
+#
+# Every source provides mono samples in the range of 16 bit integers and fills the frame of an STFT
+# (see STFT.py) with the next hop of audio. Live sources deliver audio in realtime, all other
+# sources deliver it as fast as the analysis pipeline can process it.
+
+import os
+import time
+import wave
+import numpy as np
+from RingBuffer import RingBuffer
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+# Number of hops the capture ring buffer can hold
+capture_buffer_hops = 16
+
+# Seconds between printing capture statistics
+capture_stats_interval = 5
+
+# Abstract class, defining a source of audio
+class AudioSource:
+    rate = 0
+    # True, if the source delivers audio in realtime (e.g. a microphone)
+    realtime = False
+    # Identifies the source, e.g. to store a microphone noise profile per device
+    name = ""
+    # Wall clock time at which the newest sample of the last filled frame was recorded
+    capture_time = 0
+
+    # Advances the frame of the given STFT by one hop of new samples and updates capture_time
+    # Returns False, if the source is exhausted
+    def fill(self, stft):
+        return False
+
+    # Called regularly by the analyzer, e.g. to print statistics
+    def report_stats(self):
+        pass
+
+    def close(self):
+        pass
+
+# Live audio from a PyAudio (portaudio) device
+class PyAudioSource(AudioSource):
+    realtime = True
+
+    mic = None
+    stream = None
+    channels = 1
+
+    # Filled by the stream callback in callback capture mode, None in blocking mode
+    ring_buffer = None
+    stream_overflows = 0
+    # Time of the last stream callback, i.e. when the newest sample in the ring buffer was recorded
+    callback_time = 0
+    last_capture_stats = 0
+    reported_capture_stats = (0, 0, 0)
+
+    # Called by PyAudio from its own thread whenever a new chunk of audio has been recorded
+    # Only pushes the left channel into the ring buffer, all processing happens in the analysis thread
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        self.callback_time = time.time()
+        if status & pyaudio.paInputOverflow:
+            self.stream_overflows += 1
+        data = np.frombuffer(in_data, np.int16)
+        self.ring_buffer.write(data[::self.channels])
+        return (None, pyaudio.paContinue)
+
+    def fill(self, stft):
+        if self.ring_buffer is not None:
+            # Wait for the next hop and pull the newest frame recorded by the stream callback
+            self.ring_buffer.wait(stft.hop_size, timeout = 1)
+            self.ring_buffer.read_latest(stft.fft_size, out = stft.frame)
+            self.capture_time = self.callback_time
+        else:
+            data = self.stream.read(stft.hop_size, exception_on_overflow=False)
+            self.capture_time = time.time()
+
+            data = np.frombuffer(data, np.int16)
+
+            # pull out the left channel only
+            stft.push(data[::self.channels])
+        return True
+
+    # Prints overflow and underrun counters of the audio capture, if any of them changed
+    def report_stats(self):
+        now = time.time()
+        if self.ring_buffer is None or now - self.last_capture_stats < capture_stats_interval:
+            return
+        stats = (self.stream_overflows, self.ring_buffer.overflows, self.ring_buffer.underruns)
+        if stats != self.reported_capture_stats:
+            print("Capture: {} stream overflows, {} samples skipped, {} underruns".format(*stats))
+            self.reported_capture_stats = stats
+        self.last_capture_stats = now
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.mic.terminate()
+
+    # Prints all available input devices
+    def print_devices(self):
+        numdevices = self.mic.get_host_api_info_by_index(0).get('deviceCount')
+        for i in range(0, numdevices):
+            if (self.mic.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
+                print(
+                    "Input Device id ",
+                    i,
+                    " - ",
+                    self.mic.get_device_info_by_host_api_device_index(0, i))
+
+    # Open audio stream of the given device. If no device is passed, the default input device is used
+    # capture - "callback" to record from a stream callback into a ring buffer, "blocking" to read in the analysis loop
+    def __init__(self, device, fft_size, hop_size, capture = "callback"):
+        if pyaudio is None:
+            raise Exception("PyAudioSource requires the pyaudio package to be installed")
+
+        self.mic = pyaudio.PyAudio()
+
+        if device == None:
+            self.print_devices()
+            device_info = self.mic.get_default_input_device_info()
+            print("No device selected, using default input device " + str(device_info["index"]))
+        else:
+            device_info = self.mic.get_device_info_by_index(int(device))
+
+        self.channels = device_info["maxInputChannels"] if (
+            device_info["maxOutputChannels"] < device_info["maxInputChannels"]) else device_info["maxOutputChannels"]
+        self.rate = int(device_info["defaultSampleRate"])
+        self.name = "pyaudio_" + str(device_info["name"])
+
+        # In callback mode, PyAudio pushes recorded audio into a ring buffer from its own thread
+        stream_callback = None
+        if capture == "callback":
+            self.ring_buffer = RingBuffer(max(2 * fft_size, hop_size * capture_buffer_hops))
+            stream_callback = self.audio_callback
+
+        # Open audio stream with default settings
+        self.stream = self.mic.open(format=pyaudio.paInt16,
+                                    channels=self.channels,
+                                    rate=self.rate,
+                                    input=True,
+                                    frames_per_buffer=hop_size,
+                                    input_device_index=int(device_info["index"]),
+                                    stream_callback=stream_callback)
+
+# Audio read from a WAV file. Only the left channel is used
+class WavFileSource(AudioSource):
+    samples = None
+    position = 0
+    loop = False
+
+    def fill(self, stft):
+        if self.position + stft.hop_size > len(self.samples):
+            if not self.loop or len(self.samples) < stft.hop_size:
+                return False
+            self.position = 0
+        stft.push(self.samples[self.position:self.position + stft.hop_size])
+        self.position += stft.hop_size
+        self.capture_time = time.time()
+        return True
+
+    # filename - path to a WAV file with 8, 16 or 32 bit integer samples
+    # loop - restart at the beginning once the end of the file has been reached
+    def __init__(self, filename, loop = False):
+        with wave.open(filename, "rb") as wav:
+            self.rate = wav.getframerate()
+            channels = wav.getnchannels()
+            width = wav.getsampwidth()
+            raw = wav.readframes(wav.getnframes())
+
+        # Scale samples to the range of 16 bit integers
+        if width == 1:
+            data = (np.frombuffer(raw, np.uint8).astype(np.float32) - 128) * 256
+        elif width == 2:
+            data = np.frombuffer(raw, np.int16).astype(np.float32)
+        elif width == 4:
+            data = np.frombuffer(raw, np.int32).astype(np.float32) / 65536
+        else:
+            raise ValueError("Unsupported sample width of " + str(width) + " bytes in " + str(filename))
+
+        self.name = "wav_" + os.path.basename(filename)
+        self.samples = np.ascontiguousarray(data[::channels])
+        self.position = 0
+        self.loop = loop
+
+# Synthetic sum of sine tones, optionally with white noise
+class ToneSource(AudioSource):
+    freqs = None
+    amplitude = 0
+    noise = 0
+    # Number of samples to generate, None for an endless tone
+    length = None
+    position = 0
+
+    random = None
+    chunk = None
+
+    def fill(self, stft):
+        hop = stft.hop_size
+        if self.length is not None and self.position + hop > self.length:
+            return False
+
+        if self.chunk is None or len(self.chunk) != hop:
+            self.chunk = np.zeros(hop, dtype=np.float32)
+        t = (np.arange(self.position, self.position + hop) / self.rate)[:, None]
+        self.chunk[:] = np.sum(np.sin(2 * np.pi * self.freqs * t), axis=1)
+        self.chunk *= self.amplitude / len(self.freqs)
+        if self.noise > 0:
+            self.chunk += self.random.normal(0, self.noise, hop).astype(np.float32)
+
+        stft.push(self.chunk)
+        self.position += hop
+        self.capture_time = time.time()
+        return True
+
+    # freqs - frequencies of the tones in Hz
+    # amplitude - peak amplitude of the sum of all tones, in the range of 16 bit integers
+    # noise - standard deviation of added white noise
+    # duration - length of the generated audio in seconds, None for an endless tone
+    def __init__(self, freqs, rate = 44100, amplitude = 16384, noise = 0, duration = None):
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        if len(self.freqs) == 0:
+            raise ValueError("ToneSource needs at least one frequency")
+        self.rate = rate
+        self.name = "tone"
+        self.amplitude = amplitude
+        self.noise = noise
+        self.length = None if duration is None else int(duration * rate)
+        self.position = 0
+        self.random = np.random.RandomState(0)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Benchmark of the audio to LED pipeline
+#
+# Runs every stage of the SoundAnalyzer and the led_control frame update on synthetic audio, for each
+# combination of FFT size, LED count and filter count. Messages are published to an in-process stand-in
+# for the MQTT client, so no broker is needed. Results of every run are appended as one json line
+# to the output file, so runs can be compared over time.
+
+import argparse
+import colorsys
+import configparser
+import datetime
+import functools
+import json
+import platform
+import time
+import numpy as np
+from Communication import JsonCodec, read_topics
+from Filter import UniformFilter, FilterBank, SparseFilterBank, create_band_filters
+from AudioSource import ToneSource
+import LedFrame
+import SoundAnalyzer
+import Pipeline
+from Zone import Zone
+import MockStrip
+import led_control
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fft_sizes', type=int, nargs='+', default=[1024, 4096])
+    parser.add_argument('--led_counts', type=int, nargs='+', default=[100, 300])
+    parser.add_argument('--filter_counts', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--frames', type=int, default=200, help='Number of timed calls per stage')
+    parser.add_argument('--publish_mode', choices=['frame', 'led'], default='frame')
+    parser.add_argument('--pipeline_workers', type=int, nargs='*', default=[],
+                        help='Also measure the throughput of the multi-process pipeline with these numbers of workers')
+    parser.add_argument('--pipeline_zones', type=int, default=8,
+                        help='Number of zones driven by the pipeline')
+    parser.add_argument('--pipeline_seconds', type=float, default=20,
+                        help='Seconds of synthetic audio analyzed by the pipeline, as fast as possible')
+    parser.add_argument('--output', default='benchmark_results.jsonl',
+                        help='File the results are appended to as one json line per run')
+    return parser.parse_args()
+
+# In-process stand-in for Comm. Messages are serialized with the codecs configured in the communication
+# config and delivered synchronously to all subscribers of the topic
+class LoopbackComm:
+    topics = {}
+    codecs = {}
+    subscriptions = {}
+    default_codec = JsonCodec()
+
+    messages = 0
+    bytes = 0
+
+    def is_connected(self):
+        return True
+
+    def wait_connected(self, timeout = None):
+        return True
+
+    def get_outbound_losses(self, topicId):
+        return 0
+
+    def get_outbound_stats(self):
+        return {}
+
+    def subscribe(self, topicId, callback):
+        self.subscriptions.setdefault(topicId, []).append(callback)
+
+    def publish(self, topicId, msg):
+        if topicId not in self.topics:
+            raise Exception("Topic " + str(topicId) + " can not be found under [Topics] in the provided config file")
+        codec = self.codecs.get(topicId, self.default_codec)
+        payload = codec.encode(msg)
+        if type(payload) is str:
+            payload = payload.encode()
+
+        self.messages += 1
+        self.bytes += len(payload)
+        for callback in self.subscriptions.get(topicId, []):
+            callback(codec.decode(payload))
+
+    def __init__(self, configfile = "cfg/comm.cfg"):
+        config = configparser.ConfigParser()
+        config.read(configfile)
+        (self.topics, self.codecs) = read_topics(config)
+        self.subscriptions = {}
+        self.messages = 0
+        self.bytes = 0
+
+# Creates filter_count uniform filters, evenly spaced on a log scale between 50 Hz and 8 kHz
+def create_filters(filter_count):
+    edges = np.geomspace(50, 8000, filter_count + 1)
+    filters = []
+    for i in range(filter_count):
+        colour = colorsys.hsv_to_rgb(i / filter_count, 1, 1)
+        filters.append(UniformFilter(center = (edges[i] + edges[i + 1]) / 2, width = (edges[i + 1] - edges[i]) / 2, colour = colour))
+    return filters
+
+# Calls fn frames times and returns statistics of the duration of a single call in microseconds
+def time_stage(fn, frames):
+    # Warm up caches, e.g. filter masks
+    for _ in range(min(10, frames)):
+        fn()
+    durations = np.empty(frames)
+    for i in range(frames):
+        start = time.perf_counter()
+        fn()
+        durations[i] = time.perf_counter() - start
+    durations *= 1e6
+    return {"mean_us": float(np.mean(durations)),
+            "median_us": float(np.median(durations)),
+            "p95_us": float(np.percentile(durations, 95)),
+            "calls": frames}
+
+# Sets up an analyzer with the given dimensions and times each stage of its pipeline
+def run_config(fft_size, led_count, filter_count, frames, publish_mode):
+    filters = create_filters(filter_count)
+    filter_bank = FilterBank(filters)
+    comm = LoopbackComm()
+    source = ToneSource([100, 440, 2000], noise = 100)
+    sa = SoundAnalyzer.SoundAnalyzer(source, False, publish_mode,
+                                     fft_size = fft_size, hop_size = fft_size // 2,
+                                     comm = comm, led_count = led_count, filter_bank = filter_bank)
+    sa.mic_noise_fft = 0
+
+    # Receiving side, decoding frames into the frame buffer of led_control
+    frame_buffer = np.zeros((led_count, 3), dtype=np.uint8)
+    led_control.rgb_values = frame_buffer
+    led_control.frame_decoder = LedFrame.FrameDecoder(frame_buffer)
+    led_control.strip = MockStrip.PixelStrip(led_count)
+    led_control.renderer = led_control.Renderer(led_control.strip, led_count)
+    led_control.power = "on"
+    led_control.mode = "sound"
+    comm.subscribe("rgb_frame", led_control.set_led_frame)
+    comm.subscribe("rgb_values", led_control.set_led_color)
+
+    # Intermediate results as inputs to the single stages
+    zone = sa.zones[0]
+    fft_result, fft_freq = sa.collect_values()
+    amplitudes = fft_result - np.min(fft_result)
+    color_vector = zone.get_color_vector(amplitudes, fft_freq)
+    rgb_values = zone.colorVectorToRgbValues(color_vector)
+
+    stages = {}
+    stages["collect_values"] = time_stage(sa.collect_values, frames)
+    stages["filter_per_filter"] = time_stage(lambda: [f.get_filtered_result(amplitudes, fft_freq) for f in filters], frames)
+    stages["filter_bank"] = time_stage(lambda: filter_bank.get_filtered_result(amplitudes, fft_freq), frames)
+    # Spectrum bar with one log spaced band per LED
+    band_bank = SparseFilterBank(create_band_filters(led_count, 40, 12000))
+    stages["band_filter_bank"] = time_stage(lambda: band_bank.get_filtered_result(amplitudes, fft_freq), frames)
+    stages["colorVectorToRgbValues"] = time_stage(lambda: zone.colorVectorToRgbValues(color_vector), frames)
+    comm.messages = comm.bytes = 0
+    stages["publish_rgb"] = time_stage(lambda: zone.publish_rgb(comm, rgb_values), frames)
+    stages["publish_rgb"]["bytes_per_frame"] = comm.bytes / (frames + min(10, frames))
+    stages["led_update"] = time_stage(lambda: led_control.renderer.show(frame_buffer), frames)
+    stages["pipeline"] = time_stage(sa.run, frames)
+
+    results = []
+    for stage, stats in stages.items():
+        result = {"fft_size": fft_size, "led_count": led_count, "filter_count": filter_count, "stage": stage}
+        result.update(stats)
+        results.append(result)
+    return results
+
+# Connection of the pipeline output processes
+def create_loopback_comm(name):
+    return LoopbackComm()
+
+# Spectrum analyzer of the pipeline capture process, on seconds of synthetic audio
+def create_tone_analyzer(fft_size, seconds):
+    source = ToneSource([100, 440, 2000], noise = 100, duration = seconds)
+    return SoundAnalyzer.SoundAnalyzer(source, False, fft_size = fft_size, hop_size = fft_size // 2,
+                                       comm = LoopbackComm(), zones = [])
+
+# Runs the pipeline with the given number of workers and returns the achieved frame rates. As the audio
+# is analyzed faster than realtime, later stages skip frames. The frame rate of the filter and output
+# stages is summed over all zones, i.e. the number of LED frames calculated and published per second
+def run_pipeline_config(workers, zone_count, fft_size, led_count, filter_count, seconds, publish_mode):
+    zones = [Zone("zone" + str(i), led_count, FilterBank(create_filters(filter_count)), None, publish_mode)
+             for i in range(zone_count)]
+    start = time.time()
+    stages = Pipeline.run_pipeline(functools.partial(create_tone_analyzer, fft_size, seconds), zones, workers,
+                                   create_loopback_comm, fft_size)
+    elapsed = time.time() - start
+
+    workers = max(1, min(workers, zone_count))
+    filtered = sum(result["frames"] * len(zones[int(stage[6:])::workers])
+                   for stage, result in stages.items() if stage.startswith("filter"))
+    published = sum(result["frames"] for stage, result in stages.items() if stage.startswith("output"))
+    return {"stage": "pipeline_" + str(workers) + "_workers",
+            "workers": workers, "zones": zone_count, "fft_size": fft_size, "led_count": led_count,
+            "filter_count": filter_count, "seconds": elapsed,
+            "spectra_per_s": stages["capture"]["frames"] / elapsed,
+            "zone_frames_filtered_per_s": filtered / elapsed,
+            "zone_frames_published_per_s": published / elapsed}
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    results = []
+    for fft_size in args.fft_sizes:
+        for led_count in args.led_counts:
+            for filter_count in args.filter_counts:
+                for result in run_config(fft_size, led_count, filter_count, args.frames, args.publish_mode):
+                    print("fft {:5d} leds {:4d} filters {:3d}  {:24s} {:10.1f} us".format(
+                        fft_size, led_count, filter_count, result["stage"], result["median_us"]))
+                    results.append(result)
+
+    for workers in args.pipeline_workers:
+        result = run_pipeline_config(workers, args.pipeline_zones, args.fft_sizes[0], args.led_counts[0],
+                                     args.filter_counts[0], args.pipeline_seconds, args.publish_mode)
+        print("pipeline {:2d} workers {:3d} zones  {:10.1f} spectra/s {:10.1f} zone frames filtered/s {:10.1f} published/s".format(
+            result["workers"], result["zones"], result["spectra_per_s"],
+            result["zone_frames_filtered_per_s"], result["zone_frames_published_per_s"]))
+        results.append(result)
+
+    run = {"time": datetime.datetime.now().isoformat(),
+           "host": platform.node(),
+           "machine": platform.machine(),
+           "python": platform.python_version(),
+           "numpy": np.__version__,
+           "publish_mode": args.publish_mode,
+           "frames": args.frames,
+           "results": results}
+    with open(args.output, "a") as output:
+        output.write(json.dumps(run) + "\n")
+    print("Results appended to " + str(args.output))
@@ -1,106 +1,509 @@
 # Wrapper around paho mqtt using configparser for an easy configurable communication
 # Author: Daniel Habering <daniel@habering.de>
 
+import collections
 import configparser
 import json
+import struct
+import threading
 from paho.mqtt import client as mqtt_client
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Codecs convert messages to the payload sent over mqtt and back. Which codec is used for a topic
+# is configured under [Codecs] in the communication config. Topics without an entry use json.
+# decode raises a ValueError if a payload can not be parsed
+
+# Dicts as json strings. Already serialized json strings are passed on unchanged
+class JsonCodec:
+    def encode(self, msg):
+        if type(msg) is dict:
+            return json.dumps(msg)
+        elif type(msg) is str:
+            return msg
+        raise Exception("JsonCodec only takes dict or str")
+
+    def decode(self, payload):
+        return json.loads(payload.decode())
+
+# Raw bytes, passed through without any serialization
+class RawCodec:
+    def encode(self, msg):
+        if type(msg) is bytes or type(msg) is bytearray or type(msg) is memoryview:
+            return msg
+        elif type(msg) is str:
+            return msg.encode()
+        raise Exception("RawCodec only takes bytes or str")
+
+    def decode(self, payload):
+        return payload
+
+# Tuple of values packed with a fixed struct format, e.g. "struct <fff"
+class StructCodec:
+    packer = None
+
+    def encode(self, msg):
+        return self.packer.pack(*msg)
+
+    def decode(self, payload):
+        try:
+            return self.packer.unpack(payload)
+        except struct.error as err:
+            raise ValueError(str(err))
+
+    def __init__(self, fmt):
+        self.packer = struct.Struct(fmt)
+
+# Dicts, lists and values as msgpack binary. Requires the msgpack package
+class MsgpackCodec:
+    def encode(self, msg):
+        return msgpack.packb(msg, use_bin_type=True)
+
+    def decode(self, payload):
+        try:
+            return msgpack.unpackb(payload, raw=False)
+        except Exception as err:
+            raise ValueError(str(err))
+
+    def __init__(self):
+        if msgpack is None:
+            raise Exception("msgpack codec requires the msgpack package to be installed")
+
+# Creates a codec from its config entry: codec name, followed by its arguments
+def create_codec(codec_config):
+    [name, *arguments] = codec_config.split(None, 1)
+    if name == "json":
+        return JsonCodec()
+    elif name == "raw":
+        return RawCodec()
+    elif name == "struct":
+        if not arguments:
+            raise Exception("struct codec needs a format, e.g. \"struct <fff\"")
+        return StructCodec(arguments[0].strip())
+    elif name == "msgpack":
+        return MsgpackCodec()
+    raise Exception("Unknown codec " + str(name) + ". Known codecs are json, raw, struct and msgpack")
+
+# Finds the subscriptions matching a topic. Topic filters are stored level by level, so matching a topic
+# only visits the levels of the topic and the wildcards next to them, independent of the number of
+# subscriptions. Supports the mqtt wildcards + for a single level and # for all remaining levels
+class TopicTrie:
+    children = None
+    # Subscriptions of filters ending at this node, and of filters ending with # at this node
+    subscriptions = None
+    multi_level = None
+
+    def add(self, topic_filter, subscription):
+        node = self
+        levels = topic_filter.split("/")
+        for i, level in enumerate(levels):
+            if level == "#":
+                if i != len(levels) - 1:
+                    raise Exception("Wildcard # has to be the last level of a topic: " + str(topic_filter))
+                node.multi_level.append(subscription)
+                return
+            if "#" in level or ("+" in level and level != "+"):
+                raise Exception("Wildcards have to occupy a whole topic level: " + str(topic_filter))
+            node = node.children.setdefault(level, TopicTrie())
+        node.subscriptions.append(subscription)
+
+    # Returns all subscriptions, whose filter matches the topic
+    def match(self, topic):
+        result = []
+        levels = topic.split("/")
+        nodes = [self]
+        for i, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                # Topics starting with $ are reserved for the broker and not matched by wildcards
+                if i == 0 and level.startswith("$"):
+                    if level in node.children:
+                        next_nodes.append(node.children[level])
+                    continue
+                # # also matches the parent level, e.g. a/# matches a
+                result.extend(node.multi_level)
+                if level in node.children:
+                    next_nodes.append(node.children[level])
+                if "+" in node.children:
+                    next_nodes.append(node.children["+"])
+            nodes = next_nodes
+        for node in nodes:
+            result.extend(node.subscriptions)
+            result.extend(node.multi_level)
+        return result
+
+    def __init__(self):
+        self.children = {}
+        self.subscriptions = []
+        self.multi_level = []
+
+# Replaces the + wildcards of a topic filter with the given levels, e.g. to publish to a single
+# device of a topic like /led/+/request
+def fill_topic(topic_filter, levels):
+    levels = list(levels)
+    result = []
+    for level in topic_filter.split("/"):
+        if level == "+":
+            if not levels:
+                raise Exception("Not enough levels given for topic " + str(topic_filter))
+            level = str(levels.pop(0))
+        elif level == "#":
+            raise Exception("Can not publish to topic with wildcard #: " + str(topic_filter))
+        result.append(level)
+    if levels:
+        raise Exception("Too many levels given for topic " + str(topic_filter))
+    return "/".join(result)
+
+# Limits the messages of a topic, which are handed to paho but not yet written to the network.
+# Further messages wait in a bounded queue. If the queue is full, the oldest message is dropped.
+# With conflation, a queued message is replaced by a newer one of the same topic or key, so on a slow
+# connection only the latest values are sent instead of a growing backlog of stale ones.
+# Which topics use a queue is configured under [Outbound] in the communication config
+class OutboundQueue:
+    max_inflight = 1
+    size = 1
+    # None: no conflation, "topic": keep only the newest message, otherwise the field of dict
+    # messages, whose value identifies the messages replacing each other
+    conflate = None
+
+    inflight = 0
+    queue = None
+    next_id = 0
+
+    # Counters since start
+    sent = 0
+    dropped = 0
+    conflated = 0
+
+    # Adds an encoded message for a topic to the queue. msg is the message before encoding, used to find its key
+    def put(self, topic_string, msg, payload, retain = False):
+        if self.conflate is None:
+            key = self.next_id
+            self.next_id += 1
+        elif self.conflate == "topic":
+            key = topic_string
+        elif isinstance(msg, dict) and self.conflate in msg:
+            key = (topic_string, str(msg[self.conflate]))
+        else:
+            # Messages without the key field are not conflated
+            key = self.next_id
+            self.next_id += 1
+
+        if key in self.queue:
+            # Replace the stale message, but keep its position in the queue
+            self.conflated += 1
+        elif len(self.queue) >= self.size:
+            self.queue.popitem(last = False)
+            self.dropped += 1
+        self.queue[key] = (topic_string, payload, retain)
+
+    # Returns the next queued topic, payload and retain flag or None
+    def pop(self):
+        if not self.queue:
+            return None
+        return self.queue.popitem(last = False)[1]
+
+    # Drops all queued messages, e.g. when the connection has been lost
+    def clear(self):
+        self.dropped += len(self.queue)
+        self.queue.clear()
+        self.inflight = 0
+
+    def get_stats(self):
+        return {"queued": len(self.queue),
+                "inflight": self.inflight,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "conflated": self.conflated}
+
+    # max_inflight - messages handed to paho, but not yet written to the network
+    # size - number of messages waiting in the queue
+    # conflate - None, "topic" or the name of a message field
+    def __init__(self, max_inflight = 1, size = 1, conflate = None):
+        if max_inflight < 1 or size < 1:
+            raise Exception("Outbound queue needs max_inflight and queue of at least 1")
+        self.max_inflight = max_inflight
+        self.size = size
+        self.conflate = conflate
+        self.inflight = 0
+        self.queue = collections.OrderedDict()
+        self.next_id = 0
+        self.sent = 0
+        self.dropped = 0
+        self.conflated = 0
+
+# Creates an outbound queue from its config entry, e.g. "max_inflight=1 queue=1 conflate=topic"
+# conflate is optional and can be topic or the name of a message field, e.g. conflate=id
+def create_outbound_queue(outbound_config):
+    options = {}
+    for option in outbound_config.split():
+        [name, _, value] = option.partition("=")
+        if name not in ["max_inflight", "queue", "conflate"] or not value:
+            raise Exception("Invalid outbound option " + str(option) + ". Known options are max_inflight=<n>, queue=<n> and conflate=<topic|field>")
+        options[name] = value
+
+    try:
+        max_inflight = int(options.get("max_inflight", 1))
+        size = int(options.get("queue", 1))
+    except ValueError:
+        raise Exception("max_inflight and queue need to be numbers: " + str(outbound_config))
+    return OutboundQueue(max_inflight, size, options.get("conflate"))
+
+# Reads the topics and the codecs configured for them from a communication config
+# Returns topics and codecs by topic id. Topics without a codec use json (see Comm.get_codec)
+def read_topics(config):
+    if "Topics" not in config:
+        raise Exception("Config file needs collection of topics under a section called [Topics]")
+
+    topics = {}
+    for topic_id in config["Topics"]:
+        topics[topic_id] = config["Topics"][topic_id]
+
+    codecs = {}
+    if "Codecs" in config:
+        for topic_id in config["Codecs"]:
+            if topic_id not in topics:
+                raise Exception("Codec configured for unknown topic " + str(topic_id))
+            codecs[topic_id] = create_codec(config["Codecs"][topic_id])
+    return topics, codecs
+
+# Reads the topics and codecs of a communication config file without connecting to the broker,
+# e.g. to check the configuration before starting any connections
+def load_topics(configfile = "cfg/comm.cfg"):
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    return read_topics(config)
+
 class Comm:
     client = None
     connected = False
+    # Set while connected to the broker, to wait for a connection without polling
+    connected_event = None
     topics = {}
+    # Subscriptions by topic filter, the same subscriptions indexed for matching received topics
+    # and pending subscriptions by mid
     subscriptions = {}
+    subscription_trie = None
+    pending_mids = {}
+    subscription_lock = None
+    # Called without arguments after every (re)connect
+    connect_callbacks = []
+    codecs = {}
+    default_codec = JsonCodec()
+    # Outbound queues per topic id and the topic id of each message handed to paho, by mid
+    outbound = {}
+    outbound_mids = {}
+    outbound_lock = None
 
     # Returns current connection status to broker
     def is_connected(self):
         return self.connected
 
+    # Blocks until the client is connected to the broker or timeout seconds have passed
+    # Returns the connection status. A timeout of None waits forever
+    def wait_connected(self, timeout = None):
+        return self.connected_event.wait(timeout)
+
     # Callback for mqtt, when client hast connected to broker
+    # Also called after each reconnect. The broker may have lost all subscriptions, so they are renewed
     def on_connect(self, client, userdata, flags, rc):
-        self.connected = True
+        if rc != mqtt_client.CONNACK_ACCEPTED:
+            print("Broker refused connection: " + mqtt_client.connack_string(rc))
+            return
+
+        # The connected flag is set under the same lock, so a concurrent subscribe() is either
+        # replayed here or sends its request itself
+        with self.subscription_lock:
+            for topic_string, subscription in self.subscriptions.items():
+                self.subscribe_topic(topic_string, subscription)
+            self.connected = True
+        self.connected_event.set()
+
+        for callback in list(self.connect_callbacks):
+            callback()
 
     # Callback for mqtt, when connection to broker has been lost
-    # Reset connected flag
-    def on_disconnect(self, userdata, rc):
-        self.connected = False
-        print("Connection to broker failed. Errorcode: " + str(rc))
+    # Reset connected flag. The network loop reconnects on its own
+    def on_disconnect(self, client, userdata, rc):
+        with self.subscription_lock:
+            was_connected = self.connected
+            self.connected = False
+        self.connected_event.clear()
+
+        # Queued messages would be stale after reconnecting. Messages of a lost connection are not
+        # reported as published, so in-flight counts are reset
+        with self.outbound_lock:
+            for queue in self.outbound.values():
+                queue.clear()
+            self.outbound_mids.clear()
+
+        if rc == mqtt_client.MQTT_ERR_SUCCESS:
+            return
+        if was_connected:
+            print("Connection to broker lost. Errorcode: " + str(rc) + ". Reconnecting...")
+        else:
+            print("Failed to connect to broker. Errorcode: " + str(rc) + ". Retrying...")
 
     # Callback for mqtt, when any message has been received
     def on_message(self, client, userdata, msg):
-        # Check if callback is available for received topic
-        if msg.topic not in self.subscriptions:
-            return
+        # Find all subscriptions, whose topic filter matches the received topic
+        with self.subscription_lock:
+            subscriptions = self.subscription_trie.match(msg.topic)
 
-        # Message should be a valid json string, try to parse to dict
-        try:
-            msg_dict = json.loads(str(msg.payload.decode()))
-        except json.decoder.JSONDecodeError as decode_error:
-            print("Received invalid JSON string: " + str(msg.payload) + " with error " + str(decode_error))
-            return
+        for subscription in subscriptions:
+            # Decode payload with the codec configured for this topic
+            try:
+                msg_decoded = subscription["codec"].decode(msg.payload)
+            except ValueError as decode_error:
+                print("Received invalid message: " + str(msg.payload) + " with error " + str(decode_error))
+                continue
 
-        # Pass dict to stored callback function
-        self.subscriptions[msg.topic]["callback"](msg_dict)
+            # Pass decoded message to all stored callback functions
+            for (callback, with_topic) in list(subscription["callbacks"]):
+                if with_topic:
+                    callback(msg_decoded, msg.topic)
+                else:
+                    callback(msg_decoded)
 
     # Callback for mqtt, when subscription to a topic has been successfull
     def on_subscribe(self, client, userdata, mid, granted_qos):
-        # Check for a pending subscription for this topic
-        for topic, subscription in self.subscriptions.items():
-            if subscription["mid"] == mid:
-                # Update subscription status
+        # Update status of the pending subscription with this mid
+        with self.subscription_lock:
+            subscription = self.pending_mids.pop(mid, None)
+            if subscription is not None:
                 subscription["subscribed"] = True
 
+    # Sends the subscription request for a stored subscription and remembers its mid
+    # Has to be called with subscription_lock held
+    # Returns False, if the request could not be sent, e.g. because the connection has just been lost
+    def subscribe_topic(self, topic_string, subscription):
+        subscription["subscribed"] = False
+        self.pending_mids.pop(subscription["mid"], None)
+        (result, mid) = self.client.subscribe(topic_string)
+        subscription["mid"] = mid
+        if result != mqtt_client.MQTT_ERR_SUCCESS:
+            return False
+        self.pending_mids[mid] = subscription
+        return True
+
     # To be called if a new subscription should be created. Upon successfull subscription, the passed callback will be called
     # for any message recieved on said topic
-    # The provided topicId has to match an entry in the provided communication config
-    def subscribe(self, topicId, callback):
+    # The provided topicId has to match an entry in the provided communication config. Its topic may contain the
+    # wildcards + and #, e.g. /led/+/request
+    # The callback is called with the message decoded by the codec of the topic (a dict for json topics). With
+    # with_topic, the received topic is passed as second argument, e.g. to tell apart devices of a wildcard topic
+    # Several callbacks can be subscribed to the same topic
+    # If the client is not connected yet, the subscription is sent as soon as the connection is established
+    def subscribe(self, topicId, callback, with_topic = False):
         # Check if topicID is known from communication config
         if topicId not in self.topics:
             raise Exception("Topic " + str(topicId) + " can not be found under [Topics] in the provided config file")
         topic_string = self.topics[topicId]
 
-        # Check if client is connected to broker
-        if not self.connected:
-            raise Exception("MQTT is not connected to broker, failed to subscribe to " + str(topic_string))
+        with self.subscription_lock:
+            # Further callbacks for a topic are served by the existing subscription
+            if topic_string in self.subscriptions:
+                self.subscriptions[topic_string]["callbacks"].append((callback, with_topic))
+                return
 
-        # Subscribe to topic
-        (result, mid) = self.client.subscribe(topic_string)
-        if result != mqtt_client.MQTT_ERR_SUCCESS:
-            raise Exception("Failed to subscribe to " + str(topic_string) + " with error " + str(result))
+            # Store callback, to be renewed after every reconnect
+            subscription = {"callbacks": [(callback, with_topic)], "mid": None, "subscribed": False, "codec": self.get_codec(topicId)}
+            self.subscription_trie.add(topic_string, subscription)
+            self.subscriptions[topic_string] = subscription
+
+            # Subscribe to topic
+            if self.connected and not self.subscribe_topic(topic_string, subscription):
+                print("Failed to subscribe to " + str(topic_string) + ", retrying after reconnect")
+
+    # Registers a callback, which is called without arguments after every (re)connect, e.g. to publish
+    # retained messages again, which could not be sent while the connection was down
+    # If the client is already connected, the callback is also called right away
+    def add_connect_callback(self, callback):
+        self.connect_callbacks.append(callback)
+        if self.connected:
+            callback()
+
+    # Callback for mqtt, when a message has been written to the network
+    # Sends the next queued message of the same topic
+    def on_publish(self, client, userdata, mid):
+        with self.outbound_lock:
+            topicId = self.outbound_mids.pop(mid, None)
+            if topicId is None:
+                return
+            queue = self.outbound[topicId]
+            queue.inflight = max(0, queue.inflight - 1)
+            queued = queue.pop()
+            if queued is not None:
+                self.send_queued(topicId, queue, *queued)
 
-        # Store callback and subscription mid
-        self.subscriptions[topic_string] = {"callback": callback, "mid": mid, "subscribed": False}
+    # Hands a message of a topic with outbound queue to paho. Has to be called with outbound_lock held
+    def send_queued(self, topicId, queue, topic_string, payload, retain = False):
+        info = self.client.publish(topic_string, payload, retain = retain)
+        if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            queue.dropped += 1
+            return
+        queue.inflight += 1
+        queue.sent += 1
+        self.outbound_mids[info.mid] = topicId
+
+    # Returns the number of messages of a topic, which have been dropped or replaced by a newer one
+    def get_outbound_losses(self, topicId):
+        if topicId not in self.outbound:
+            return 0
+        queue = self.outbound[topicId]
+        return queue.dropped + queue.conflated
+
+    # Returns queue depth, in-flight messages and sent, dropped and conflated counters per topic id
+    # of all topics with an outbound queue
+    def get_outbound_stats(self):
+        with self.outbound_lock:
+            return {topicId: queue.get_stats() for topicId, queue in self.outbound.items()}
 
     # To be called to publish a msg to a given topicID
     # The provided topicId has to match an entry in the provided communication config
-    # The msg has to be a valid JSON string or a dictionary
-    def publish(self, topicId, msg):
+    # The msg has to be supported by the codec of the topic, e.g. a dictionary or JSON string for json topics
+    # Returns False, if the message has been dropped because the client is not connected to the broker
+    # For topics with an outbound queue, the message may be queued and later dropped or replaced by a newer one
+    # For topics with + wildcards, levels replaces the wildcards, e.g. levels = ["strip1"] for /led/+/request
+    # With retain, the broker keeps the message as last value of the topic and hands it to every new subscriber
+    def publish(self, topicId, msg, levels = None, retain = False):
         # Check if topic is known
         if topicId not in self.topics:
             raise Exception("Topic " + str(topicId) + " can not be found under [Topics] in the provided config file")
         topic_string = self.topics[topicId]
+        if levels is not None:
+            topic_string = fill_topic(topic_string, levels)
 
-        # Check if client is connected to broker
+        # Drop messages while not connected, e.g. while reconnecting after a broker restart
         if not self.connected:
-            raise Exception("MQTT is not connected to broker, failed to publish to topic")
+            if topicId in self.outbound:
+                self.outbound[topicId].dropped += 1
+            return False
 
-        # Create json string from msg
-        msg_string = ""
-        if type(msg) is dict:
-            # Create json string from dict
-            msg_string = json.dumps(msg)
-        elif type(msg) is str:
-            # Check if msg is a valid json string
-            try:
-                json.loads(msg)
-            except ValueError as error:
-                print("Can only publish valid json strings: " + str(error))
-                return
-            msg_string = msg
-        else:
-            raise Exception("Comm.publish only takes dict or str")
+        # Serialize msg with the codec configured for this topic
+        msg_string = self.get_codec(topicId).encode(msg)
+
+        if topicId in self.outbound:
+            queue = self.outbound[topicId]
+            with self.outbound_lock:
+                if queue.inflight < queue.max_inflight:
+                    self.send_queued(topicId, queue, topic_string, msg_string, retain)
+                else:
+                    queue.put(topic_string, msg, msg_string, retain)
+            return True
 
         # Publish message on topic
-        self.client.publish(topic_string, msg_string)
+        self.client.publish(topic_string, msg_string, retain = retain)
+        return True
+
+    # Returns the codec used for a topic. Defaults to json
+    def get_codec(self, topicId):
+        if topicId not in self.codecs:
+            return self.default_codec
+        return self.codecs[topicId]
 
     # Read Broker config from config file
     def readBrokerConfigField(self, config, field):
@@ -119,23 +522,39 @@ class Comm:
         broker_port = int(self.readBrokerConfigField(config, "port"))
         broker_username = str(self.readBrokerConfigField(config, "username"))
         broker_pw = str(self.readBrokerConfigField(config, "password"))
+        # Seconds to wait before reconnecting. The delay doubles after each failed attempt up to the maximum
+        reconnect_min_delay = int(config["Broker"].get("reconnect_min_delay", 1))
+        reconnect_max_delay = int(config["Broker"].get("reconnect_max_delay", 60))
 
-        if "Topics" not in config:
-            raise Exception("Config file needs collection of topics under a section called [Topics]")
+        (self.topics, self.codecs) = read_topics(config)
 
-        for topic_id in config["Topics"]:
-            self.topics[topic_id] = config["Topics"][topic_id]
+        self.subscriptions = {}
+        self.subscription_trie = TopicTrie()
+        self.pending_mids = {}
+        self.subscription_lock = threading.Lock()
+
+        self.connected = False
+        self.connected_event = threading.Event()
+        self.connect_callbacks = []
+
+        self.outbound = {}
+        self.outbound_mids = {}
+        self.outbound_lock = threading.Lock()
+        if "Outbound" in config:
+            for topic_id in config["Outbound"]:
+                if topic_id not in self.topics:
+                    raise Exception("Outbound queue configured for unknown topic " + str(topic_id))
+                self.outbound[topic_id] = create_outbound_queue(config["Outbound"][topic_id])
 
         self.client = mqtt_client.Client(client_id)
         self.client.username_pw_set(broker_username, broker_pw)
         self.client.on_connect = self.on_connect
-        #self.client.on_disconnect = self.on_disconnect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
         self.client.on_subscribe = self.on_subscribe
+        self.client.on_publish = self.on_publish
+        self.client.reconnect_delay_set(reconnect_min_delay, reconnect_max_delay)
 
-        try:
-            self.client.connect(broker_ip, broker_port)
-        except ConnectionRefusedError as err:
-            raise Exception("Failed to connect to broker. Check that broker is running under " + str(broker_ip) + str(broker_port) + " and that username and pw are correct")
-
+        # Connect in the network loop, which keeps retrying until the broker is reachable
+        self.client.connect_async(broker_ip, broker_port)
         self.client.loop_start()
\ No newline at end of file
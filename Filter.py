@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 
 # Abstract class, defining a filter to be used on frequency spectrum
 
@@ -22,6 +23,11 @@ class Filter:
     def init_filter(self):
         pass
 
+    # Returns the filter mask for a whole array of frequencies at once.
+    # Subclasses should override this with a vectorized version of filter_mask
+    def get_mask(self, freq):
+        return np.array([self.filter_mask(f) for f in freq], dtype=np.float64)
+
     # Calculates the filter applied to a given set of amplitudes/frequencies
     # amplitudes - amplitudes of the frequencies
     # freq - list of frequencies. Has to have the same size as amplitudes
@@ -32,22 +38,17 @@ class Filter:
                 str("List of frequencies does not have the same length as list of amplitudes: {} != {} ").format(
                     len(amplitudes), len(freq)))
         # Check if frequency list matches previous lists. If yes, filter mask can be reused
-        if not np.array_equal(freq, self.freq_buffer):
+        if freq is not self.freq_buffer and not np.array_equal(freq, self.freq_buffer):
             self.freq_buffer = freq
-            for f in freq:
-                self.result_buffer.append(self.filter_mask(f))
+            self.result_buffer = self.get_mask(freq)
 
-        # Apply filter mask to amplitudes, by summing up the product of amplitude and mask value
-        result = 0
+        amplitudes = np.asarray(amplitudes)
+        if np.any(amplitudes < 0):
+            i = int(np.argmax(amplitudes < 0))
+            raise ValueError("Negative amplitude " + str(amplitudes[i]) + " for frequency " + str(freq[i]) + " is not allowed")
 
-        for i, v in enumerate(amplitudes):
-            # Assuming that the filter mask has a single area, we can terminate early if we have moved over the filter area
-            if result > 0 and self.result_buffer[i] < 0.0000001:
-                break
-            if v < 0:
-                raise ValueError("Negative amplitude " + str(v) + " for frequency " + str(freq[i]) + " is not allowed")
-            result += self.result_buffer[i] * v
-        return result
+        # Apply filter mask to amplitudes, by summing up the product of amplitude and mask value
+        return float(np.dot(self.result_buffer, amplitudes))
 
     def __init__(self, center, width, colour):
         self.center = center
@@ -66,6 +67,9 @@ class GaussianFilter(Filter):
             np.exp(-np.power((x - self.center) / self.width, 2.) / 2)
         return value
 
+    def get_mask(self, freq):
+        return self.filter_mask(np.asarray(freq, dtype=np.float64))
+
     def init_filter(self):
         self.constant = 1. / (np.sqrt(2. * np.pi) * self.width)
 
@@ -77,3 +81,124 @@ class UniformFilter(Filter):
         else:
             value = 0
         return value
+
+    def get_mask(self, freq):
+        freq = np.asarray(freq, dtype=np.float64)
+        inside = (freq > self.center - self.width) & (freq < self.center + self.width)
+        return np.where(inside, 1 / (2*self.width), 0.)
+
+# Collection of filters, which are applied to a spectrum all at once.
+# The masks of all filters are stacked into one matrix (filters x frequency bins),
+# so the responses of every filter can be calculated with a single matrix-vector product.
+# The matrix is only rebuilt if the list of frequencies changes
+class FilterBank:
+    filters = []
+    mask = None
+    freq_buffer = None
+
+    # Stacks the masks of all filters for the given frequencies
+    def update_mask(self, freq):
+        self.mask = np.vstack([f.get_mask(freq) for f in self.filters])
+        self.freq_buffer = freq
+
+    # Colours of all filters, in the same order as the filter responses
+    def get_colours(self):
+        return np.array([f.colour for f in self.filters], dtype=np.float32)
+
+    # Calculates the response of every filter to the given set of amplitudes/frequencies
+    # Returns an array containing one value per filter
+    def get_filtered_result(self, amplitudes, freq):
+        if len(amplitudes) != len(freq):
+            raise ValueError(
+                str("List of frequencies does not have the same length as list of amplitudes: {} != {} ").format(
+                    len(amplitudes), len(freq)))
+        if self.mask is None or (freq is not self.freq_buffer and not np.array_equal(freq, self.freq_buffer)):
+            self.update_mask(freq)
+
+        amplitudes = np.asarray(amplitudes)
+        if np.any(amplitudes < 0):
+            i = int(np.argmax(amplitudes < 0))
+            raise ValueError("Negative amplitude " + str(amplitudes[i]) + " for frequency " + str(freq[i]) + " is not allowed")
+
+        return self.mask.dot(amplitudes)
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.mask = None
+        self.freq_buffer = None
+
+# Triangular filter rising from lower to a peak at center and falling to upper, as used by mel filterbanks
+# The weights of the frequencies inside the triangle sum up to one, so the response is the weighted
+# average amplitude of the band, independent of its width
+class TriangularFilter(Filter):
+    lower = 0
+    upper = 0
+
+    def filter_mask(self, x):
+        if x <= self.lower or x >= self.upper:
+            return 0
+        elif x <= self.center:
+            return (x - self.lower) / (self.center - self.lower)
+        return (self.upper - x) / (self.upper - self.center)
+
+    # Returns the indices of the frequencies inside the triangle and their weights
+    # Only visits those frequencies, so the cost is independent of the size of the spectrum. If no
+    # frequency lies inside (narrow bands at low frequencies), the nearest frequency is used instead
+    def get_sparse_mask(self, freq):
+        start = int(np.searchsorted(freq, self.lower, side='right'))
+        end = int(np.searchsorted(freq, self.upper, side='left'))
+        x = np.asarray(freq[start:end], dtype=np.float64)
+        weights = np.minimum((x - self.lower) / (self.center - self.lower), (self.upper - x) / (self.upper - self.center))
+        if len(weights) == 0 or np.sum(weights) <= 0:
+            nearest = int(np.argmin(np.abs(np.asarray(freq) - self.center)))
+            return np.array([nearest]), np.array([1.])
+        return np.arange(start, end), weights / np.sum(weights)
+
+    def get_mask(self, freq):
+        mask = np.zeros(len(freq), dtype=np.float64)
+        indices, weights = self.get_sparse_mask(freq)
+        mask[indices] = weights
+        return mask
+
+    def __init__(self, lower, center, upper, colour):
+        if not lower < center < upper:
+            raise ValueError("Triangular filter needs lower < center < upper: " + str((lower, center, upper)))
+        self.lower = lower
+        self.upper = upper
+        super().__init__(center, (upper - lower) / 2, colour)
+
+# Filter bank of filters, which only cover a small part of the spectrum each, e.g. one narrow band per LED
+# The masks are stored as sparse matrix, so applying the bank costs time proportional to the number of
+# nonzero weights instead of filters x frequency bins
+class SparseFilterBank(FilterBank):
+    def update_mask(self, freq):
+        freq = np.asarray(freq)
+        masks = [f.get_sparse_mask(freq) for f in self.filters]
+        indptr = np.concatenate(([0], np.cumsum([len(indices) for indices, _ in masks])))
+        indices = np.concatenate([indices for indices, _ in masks])
+        weights = np.concatenate([weights for _, weights in masks])
+        self.mask = sparse.csr_matrix((weights, indices, indptr), shape=(len(self.filters), len(freq)))
+        self.freq_buffer = freq
+
+# Converts between frequency in Hz and the mel scale
+def hz_to_mel(freq):
+    return 2595 * np.log10(1 + np.asarray(freq) / 700)
+
+def mel_to_hz(mel):
+    return 700 * (np.power(10, np.asarray(mel) / 2595) - 1)
+
+# Creates band_count overlapping triangular filters between fmin and fmax, evenly spaced on a log or mel scale
+# colours - one colour per band
+def create_band_filters(band_count, fmin, fmax, scale = "log", colours = None):
+    if band_count < 1 or not 0 < fmin < fmax:
+        raise ValueError("Bands need band_count >= 1 and 0 < fmin < fmax: " + str((band_count, fmin, fmax)))
+    if scale == "log":
+        edges = np.geomspace(fmin, fmax, band_count + 2)
+    elif scale == "mel":
+        edges = mel_to_hz(np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), band_count + 2))
+    else:
+        raise ValueError("Unknown band scale " + str(scale) + ". Known scales are log and mel")
+
+    if colours is None:
+        colours = [(1, 1, 1)] * band_count
+    return [TriangularFilter(edges[i], edges[i + 1], edges[i + 2], tuple(colours[i])) for i in range(band_count)]
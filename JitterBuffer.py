@@ -0,0 +1,109 @@
+# Buffers the last received LED frames and interpolates between them at the local render rate
+#
+# Frames are played back on the clock of their capture time, delayed by a fixed amount. The delay absorbs
+# irregular network arrival: as long as a frame arrives within the delay, playback stays smooth. Between
+# two received frames, the shown frame is crossfaded according to the current playback time, so a low
+# publish rate does not result in visible steps.
+#
+# Sender and receiver clocks do not need to be synchronized. The offset between capture and receive time
+# is tracked along its lower envelope: it follows faster transmissions immediately and slower ones only
+# gradually, so single late frames do not shift the playback clock.
+
+import numpy as np
+
+class JitterBuffer:
+    frames = None
+    times = None
+    # Index of the next slot to write and number of buffered frames
+    head = 0
+    count = 0
+
+    # Seconds by which playback is delayed behind the fastest transmission
+    delay = 0
+    # Estimated offset between capture time and receive time
+    offset = None
+    # Rate at which offset follows slower transmissions
+    offset_adapt = 0.01
+
+    blend = None
+    # Identifies the last rendered frame, to skip rendering the same frame twice
+    last_rendered = None
+
+    # Adds a received frame. Frames captured before the newest buffered frame are dropped
+    # Returns False, if the frame has been dropped
+    def push(self, frame, capture_time, receive_time):
+        if self.count > 0 and capture_time <= self.times[(self.head - 1) % len(self.times)]:
+            return False
+
+        sample = receive_time - capture_time
+        if self.offset is None or sample < self.offset:
+            self.offset = sample
+        else:
+            self.offset += self.offset_adapt * (sample - self.offset)
+
+        self.frames[self.head] = frame
+        self.times[self.head] = capture_time
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+        return True
+
+    # Returns the capture time currently played back
+    def play_time(self, now):
+        return now - self.offset - self.delay
+
+    # True, if render would produce a frame, which has not been rendered yet
+    def active(self, now):
+        if self.count == 0:
+            return False
+        newest = (self.head - 1) % len(self.times)
+        return self.play_time(now) < self.times[newest] or self.last_rendered != ("frame", self.times[newest])
+
+    # Renders the frame at the current playback time into out
+    # Returns False, if there is nothing new to render
+    def render(self, now, out):
+        if self.count == 0:
+            return False
+        size = len(self.times)
+        play = self.play_time(now)
+        oldest = (self.head - self.count) % size
+        newest = (self.head - 1) % size
+
+        # Before the oldest or after the newest frame, hold that frame
+        if play <= self.times[oldest] or play >= self.times[newest]:
+            index = oldest if play <= self.times[oldest] else newest
+            key = ("frame", self.times[index])
+            if key == self.last_rendered:
+                return False
+            out[:] = self.frames[index]
+            self.last_rendered = key
+            return True
+
+        # Find the two frames surrounding the playback time. Older frames are not needed anymore
+        for k in range(self.count - 1):
+            i = (oldest + k) % size
+            j = (i + 1) % size
+            if self.times[i] <= play < self.times[j]:
+                self.count -= k
+                break
+
+        alpha = (play - self.times[i]) / (self.times[j] - self.times[i])
+        np.multiply(self.frames[i], 1 - alpha, out=self.blend)
+        self.blend += alpha * self.frames[j]
+        # Round to the nearest uint8 value
+        self.blend += 0.5
+        np.copyto(out, self.blend, casting='unsafe')
+        self.last_rendered = ("blend", play)
+        return True
+
+    # led_count - number of LEDs per frame
+    # delay - seconds of buffering
+    # capacity - maximum number of buffered frames
+    def __init__(self, led_count, delay = 0.05, capacity = 8):
+        self.frames = np.zeros((capacity, led_count, 3), dtype=np.uint8)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+        self.delay = delay
+        self.offset = None
+        self.blend = np.zeros((led_count, 3), dtype=np.float32)
+        self.last_rendered = None
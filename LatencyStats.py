@@ -0,0 +1,115 @@
+# Collects latency histograms and counters of the stages of a node, to be published periodically
+#
+# Latencies are sorted into fixed, roughly logarithmic buckets, so recording a value is cheap and the
+# memory used does not grow. After each report, all histograms and counters are reset.
+
+import bisect
+import threading
+import time
+
+# Upper edges of the histogram buckets in milliseconds. The last bucket collects everything above
+BUCKET_EDGES_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# Histogram of the latencies of a single stage
+class Histogram:
+    counts = None
+    count = 0
+    total = 0
+    max = 0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(BUCKET_EDGES_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    # Returns the upper edge of the bucket containing the given quantile
+    def quantile(self, q):
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c > 0:
+                return BUCKET_EDGES_MS[i] if i < len(BUCKET_EDGES_MS) else self.max
+        return 0
+
+    def to_dict(self):
+        return {"count": self.count,
+                "mean_ms": self.total / self.count if self.count > 0 else 0,
+                "max_ms": self.max,
+                "p50_ms": self.quantile(0.5),
+                "p95_ms": self.quantile(0.95),
+                "counts": list(self.counts)}
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_EDGES_MS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+class LatencyStats:
+    node = ""
+    interval = 0
+    histograms = {}
+    counters = {}
+    gauges = {}
+    last_report = 0
+    lock = None
+
+    # Records the latency of a stage in seconds
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].record(seconds * 1000)
+
+    # Increases a counter, e.g. of dropped frames
+    def count(self, counter, n = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    # Sets a value, which is reported as is, e.g. a frame rate
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    # Returns True, if the report interval has passed since the last report
+    def due(self):
+        return time.time() - self.last_report >= self.interval
+
+    # Returns a dict of all histograms and counters since the last report and resets them
+    def report(self):
+        now = time.time()
+        with self.lock:
+            result = {"node": self.node,
+                      "time": now,
+                      "interval_s": now - self.last_report,
+                      "bucket_edges_ms": BUCKET_EDGES_MS,
+                      "stages": {stage: h.to_dict() for stage, h in self.histograms.items()},
+                      "counters": dict(self.counters),
+                      "gauges": dict(self.gauges)}
+            self.histograms = {}
+            self.counters = {}
+            self.last_report = now
+        return result
+
+    # Publishes the report on the given topic, if the report interval has passed
+    def publish_if_due(self, comm, topicId):
+        if not self.due():
+            return
+        try:
+            comm.publish(topicId, self.report())
+        except Exception as err:
+            print("Failed to publish stats: " + str(err))
+
+    # node - name of the node, included in every report
+    # interval - seconds between two reports
+    def __init__(self, node, interval = 10):
+        self.node = node
+        self.interval = interval
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.last_report = time.time()
+        self.lock = threading.Lock()
@@ -0,0 +1,192 @@
+# Compact binary encoding of complete LED frames, to publish a whole LED chain in a single message
+#
+# A frame consists of a fixed size header followed by the packed rgb bytes of every LED:
+#   type (uint8) | sequence number (uint32) | capture time (float64) | LED count (uint16) | r0 g0 b0 r1 g1 b1 ...
+# The capture time is the wall clock time (in seconds since epoch) at which the audio of the frame was recorded,
+# so receivers can measure the end to end latency.
+#
+# Besides these full frames (keyframes), a stream of frames can be sent as deltas against the previous frame.
+# A delta frame has the same header, followed by any number of runs of changed LEDs:
+#   start (uint16) | length (uint16) | rgb bytes of the run ...
+# A delta can only be applied if the previous frame has been received. Otherwise the receiver
+# waits for the next keyframe to resynchronize.
+
+import struct
+import numpy as np
+
+FRAME_HEADER = struct.Struct("<BIdH")
+RUN_HEADER = struct.Struct("<HH")
+
+# Frame types
+FRAME_FULL = 1
+FRAME_DELTA = 2
+
+# Sequence numbers wrap around at 2^32
+SEQ_MODULO = 1 << 32
+# Jumps of the sequence number by at least this many frames are counted as resync instead of dropped frames
+MAX_SEQ_GAP = SEQ_MODULO // 2
+
+# Converts rgb values in the range [0, 1] to packed uint8 values
+def rgb_to_bytes(rgb_values):
+    rgb_values = np.asarray(rgb_values)
+    if rgb_values.dtype == np.uint8:
+        return rgb_values
+    return (np.clip(rgb_values, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+# Creates a frame message from an (LED count, 3) array of rgb values
+# rgb_values - either uint8 values or floats in the range [0, 1]
+# seq - frame sequence number
+# capture_time - time at which the audio of this frame was recorded
+def encode_frame(rgb_values, seq, capture_time = 0.0):
+    rgb_bytes = rgb_to_bytes(rgb_values)
+    header = FRAME_HEADER.pack(FRAME_FULL, seq % SEQ_MODULO, capture_time, len(rgb_bytes))
+    return header + rgb_bytes.tobytes()
+
+# Parses the header of a frame message
+# Returns frame type, sequence number, capture time and LED count
+def decode_header(payload):
+    if len(payload) < FRAME_HEADER.size:
+        raise ValueError("Frame message is too short: " + str(len(payload)) + " bytes")
+    return FRAME_HEADER.unpack_from(payload)
+
+# Decodes a frame message directly into an existing (LED count, 3) uint8 frame buffer
+# If the frame and the buffer differ in size, only the overlapping LEDs are written
+# Returns the sequence number of the frame
+def decode_frame_into(payload, frame_buffer):
+    frame_type, seq, _, count = decode_header(payload)
+    if frame_type != FRAME_FULL:
+        raise ValueError("Unknown frame type: " + str(frame_type))
+    if len(payload) != FRAME_HEADER.size + 3 * count:
+        raise ValueError("Frame message length " + str(len(payload)) + " does not match LED count " + str(count))
+
+    rgb_bytes = np.frombuffer(payload, dtype=np.uint8, offset=FRAME_HEADER.size).reshape(count, 3)
+    n = min(count, len(frame_buffer))
+    frame_buffer[:n] = rgb_bytes[:n]
+    return seq
+
+# Decodes a frame message into a new (LED count, 3) uint8 array
+# Returns sequence number and rgb values
+def decode_frame(payload):
+    _, _, _, count = decode_header(payload)
+    frame_buffer = np.zeros((count, 3), dtype=np.uint8)
+    seq = decode_frame_into(payload, frame_buffer)
+    return seq, frame_buffer
+
+# Encodes a stream of frames, sending only the runs of changed LEDs against the previous frame
+# Every keyframe_interval frames, or if the delta would not be smaller, a full frame is sent instead
+class FrameEncoder:
+    keyframe_interval = 0
+    seq = 0
+    previous = None
+
+    # Returns the message for the next frame of the stream
+    def encode(self, rgb_values, capture_time = 0.0):
+        rgb_bytes = rgb_to_bytes(rgb_values)
+        seq = self.seq
+        self.seq = (self.seq + 1) % SEQ_MODULO
+
+        if self.previous is None or self.previous.shape != rgb_bytes.shape or seq % self.keyframe_interval == 0:
+            return self.keyframe(rgb_bytes, seq, capture_time)
+
+        # Find changed LEDs. Runs separated by a single unchanged LED are merged, as
+        # resending that LED is cheaper than a new run header
+        changed = np.flatnonzero(np.any(rgb_bytes != self.previous, axis=1))
+        splits = np.flatnonzero(np.diff(changed) > 2) + 1
+        starts = changed[np.concatenate(([0], splits))] if len(changed) else changed
+        ends = changed[np.concatenate((splits - 1, [len(changed) - 1]))] + 1 if len(changed) else changed
+
+        size = FRAME_HEADER.size + len(starts) * RUN_HEADER.size + 3 * int(np.sum(ends - starts))
+        if size >= FRAME_HEADER.size + rgb_bytes.nbytes:
+            return self.keyframe(rgb_bytes, seq, capture_time)
+
+        msg = bytearray(FRAME_HEADER.pack(FRAME_DELTA, seq, capture_time, len(rgb_bytes)))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            msg += RUN_HEADER.pack(start, end - start)
+            msg += rgb_bytes[start:end].tobytes()
+        np.copyto(self.previous, rgb_bytes)
+        return bytes(msg)
+
+    # Makes the next frame a keyframe, e.g. after a frame has been lost on the way to the receiver
+    def request_keyframe(self):
+        self.previous = None
+
+    def keyframe(self, rgb_bytes, seq, capture_time):
+        self.previous = np.array(rgb_bytes, dtype=np.uint8)
+        return encode_frame(rgb_bytes, seq, capture_time)
+
+    def __init__(self, keyframe_interval = 30):
+        if keyframe_interval < 1:
+            raise ValueError("Keyframe interval has to be at least 1: " + str(keyframe_interval))
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.previous = None
+
+# Decodes a stream of full and delta frames into an (LED count, 3) uint8 frame buffer
+class FrameDecoder:
+    frame_buffer = None
+    # Sequence number of the last received frame
+    seq = None
+    # Capture time of the last frame applied to the frame buffer
+    capture_time = 0.0
+    # False, if a frame has been missed and deltas can not be applied until the next keyframe
+    synced = False
+    # Number of frames, which were lost on the way
+    dropped = 0
+
+    # Applies a frame message to the frame buffer
+    # Returns True, if the frame buffer has been updated
+    def decode(self, payload):
+        frame_type, seq, capture_time, count = decode_header(payload)
+        if frame_type != FRAME_FULL and frame_type != FRAME_DELTA:
+            raise ValueError("Unknown frame type: " + str(frame_type))
+
+        # Check for missed frames. Only forward gaps count as dropped. Anything else, e.g. a duplicate
+        # or a sender restarting at 0, is a jump to a new position in the stream
+        if self.seq is not None and seq != (self.seq + 1) % SEQ_MODULO:
+            gap = (seq - self.seq - 1) % SEQ_MODULO
+            if gap < MAX_SEQ_GAP:
+                self.dropped += gap
+            self.synced = False
+        self.seq = seq
+
+        if frame_type == FRAME_FULL:
+            decode_frame_into(payload, self.frame_buffer)
+            self.synced = True
+            self.capture_time = capture_time
+            return True
+
+        # Delta can only be applied to its direct predecessor
+        if not self.synced:
+            return False
+
+        runs = []
+        offset = FRAME_HEADER.size
+        while offset < len(payload):
+            if offset + RUN_HEADER.size > len(payload):
+                self.synced = False
+                raise ValueError("Truncated run header in delta frame at byte " + str(offset))
+            start, length = RUN_HEADER.unpack_from(payload, offset)
+            offset += RUN_HEADER.size
+            if offset + 3 * length > len(payload) or start + length > count:
+                self.synced = False
+                raise ValueError("Invalid run " + str(start) + "+" + str(length) + " in delta frame")
+            runs.append((start, length, offset))
+            offset += 3 * length
+
+        # Only apply the delta once it has been fully validated
+        n = len(self.frame_buffer)
+        for start, length, run_offset in runs:
+            if start >= n:
+                continue
+            length = min(length, n - start)
+            rgb_bytes = np.frombuffer(payload, dtype=np.uint8, count=3 * length, offset=run_offset)
+            self.frame_buffer[start:start + length] = rgb_bytes.reshape(length, 3)
+        self.capture_time = capture_time
+        return True
+
+    def __init__(self, frame_buffer):
+        self.frame_buffer = frame_buffer
+        self.seq = None
+        self.synced = False
+        self.capture_time = 0.0
+        self.dropped = 0
@@ -0,0 +1,56 @@
+# Stand-in for the rpi_ws281x PixelStrip, to run and test led_control without a Raspberry Pi
+#
+# Keeps the pixels in memory and counts calls to show(), so tests can check what would have been shown.
+
+import numpy as np
+
+# Packs rgb (and white) values into the 24/32 bit word used by the strip, like rpi_ws281x.Color
+def Color(red, green, blue, white = 0):
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+class PixelStrip:
+    # Packed colour of each pixel, as set by setPixelColor
+    pixels = None
+    # Copy of the pixels at the time of the last show()
+    shown = None
+    show_count = 0
+    brightness = 255
+
+    def begin(self):
+        pass
+
+    def show(self):
+        np.copyto(self.shown, self.pixels)
+        self.show_count += 1
+
+    def setPixelColor(self, n, color):
+        self.pixels[n] = color
+
+    def setPixelColorRGB(self, n, red, green, blue, white = 0):
+        self.setPixelColor(n, Color(red, green, blue, white))
+
+    def getPixelColor(self, n):
+        return int(self.pixels[n])
+
+    def getPixels(self):
+        return self.pixels
+
+    def numPixels(self):
+        return len(self.pixels)
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def getBrightness(self):
+        return self.brightness
+
+    # Returns the shown pixels as an (LED count, 3) uint8 rgb array
+    def shown_rgb(self):
+        return np.stack(((self.shown >> 16) & 0xff, (self.shown >> 8) & 0xff, self.shown & 0xff), axis=1).astype(np.uint8)
+
+    # Takes the same arguments as rpi_ws281x.PixelStrip, only the number of pixels and brightness are used
+    def __init__(self, num, pin = 18, freq_hz = 800000, dma = 10, invert = False, brightness = 255, channel = 0, strip_type = None, gamma = None):
+        self.pixels = np.zeros(num, dtype=np.uint32)
+        self.shown = np.zeros(num, dtype=np.uint32)
+        self.show_count = 0
+        self.brightness = brightness
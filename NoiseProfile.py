@@ -0,0 +1,58 @@
+# Microphone noise profiles, measured while no sound is playing and subtracted from every spectrum
+#
+# A profile holds mean and variance of the noise per frequency bin. It is only valid for the audio
+# device, sample rate and FFT size it has been measured with, so profiles are stored in one file per
+# combination of those and loaded on later starts instead of calibrating again.
+
+import os
+import re
+import numpy as np
+
+class NoiseProfile:
+    mean = None
+    var = None
+    # Number of spectra the profile has been calculated from
+    count = 0
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.savez(path, mean=self.mean, var=self.var, count=self.count)
+
+    def __init__(self, mean, var, count):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.var = np.asarray(var, dtype=np.float32)
+        self.count = int(count)
+
+# Path of the profile for the given device, sample rate and FFT size
+def profile_path(directory, device, rate, fft_size):
+    device = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(device))
+    return os.path.join(directory, "mic_noise_{}_{}_{}.npz".format(device, rate, fft_size))
+
+# Loads a profile. Returns None, if no profile exists under path or it does not match the number of bins
+def load_profile(path, bins):
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        profile = NoiseProfile(data["mean"], data["var"], data["count"])
+    if len(profile.mean) != bins:
+        print("Ignoring noise profile " + str(path) + " with " + str(len(profile.mean)) + " instead of " + str(bins) + " bins")
+        return None
+    return profile
+
+# Measures a profile from the next frames spectra returned by collect
+# collect - function returning the next spectrum, or None if no more audio is available
+def calibrate(collect, frames, bins):
+    spectra = np.empty((frames, bins), dtype=np.float32)
+    count = 0
+    while count < frames:
+        spectrum = collect()
+        if spectrum is None:
+            break
+        spectra[count] = spectrum
+        count += 1
+
+    if count == 0:
+        raise Exception("No audio available to calibrate microphone noise")
+    return NoiseProfile(np.mean(spectra[:count], axis=0), np.var(spectra[:count], axis=0), count)
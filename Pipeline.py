@@ -0,0 +1,184 @@
+# Runs the SoundAnalyzer as a pipeline of processes, so capture, filtering and publishing use separate cores
+#
+#   capture process:  audio source -> STFT -> smoothing -> spectra ring
+#   filter processes: spectra ring -> filters and mapping of their zones -> one frame ring per zone
+#   output processes: frame rings -> frame encoding -> mqtt
+#
+# The zones are split evenly across the workers, each consisting of one filter and one output process.
+# Spectra are passed as float32 and LED frames as uint8 through SharedRings (see RingBuffer.py). Every
+# stage always processes the newest record of its input, records it was too slow for are counted as overruns.
+
+import multiprocessing
+import queue
+import signal
+import time
+import numpy as np
+from Communication import Comm
+from LatencyStats import LatencyStats
+from RingBuffer import SharedRing
+import LedFrame
+
+# Records kept in each ring
+RING_SLOTS = 8
+
+# Seconds a stage waits for new input, before checking whether it should stop
+POLL_TIMEOUT = 0.5
+
+# Creates the connection of an output process. It connects in the background, see wait_connected
+def create_comm(name):
+    return Comm(name)
+
+# Waits until the output process is connected to the broker
+# Returns False, if the pipeline is stopped or its input ends before, e.g. while the broker is unreachable
+def wait_connected(comm, frame_rings, stop):
+    print("Wait for MQTT to connect to broker...")
+    while not comm.wait_connected(POLL_TIMEOUT):
+        if stop.is_set() or frame_rings[0].is_closed():
+            return False
+    return True
+
+# Stages are stopped by the stop event of the main process, not by Ctrl-C in each of them
+def ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Calculates spectra and writes them to the spectra ring
+# create_analyzer - creates a SoundAnalyzer without zones, including its audio source
+# rate - shared value, to pass the sample rate of the audio source to the filter processes
+def capture_process(create_analyzer, spectra, rate, stop, results):
+    ignore_interrupt()
+    sa = None
+    frames = 0
+    start = time.time()
+    try:
+        sa = create_analyzer()
+        rate.value = sa.RATE
+        start = time.time()
+        while not stop.is_set():
+            spectrum, _ = sa.analyze()
+            if spectrum is None:
+                break
+            spectra.write(spectrum, sa.source.capture_time)
+            spectra.notify()
+            sa.source.report_stats()
+            frames += 1
+    finally:
+        spectra.close_writer()
+        if sa is not None:
+            sa.source.close()
+        results.put(("capture", {"frames": frames, "seconds": time.time() - start}))
+
+# Maps the newest spectrum onto the LEDs of each zone and writes the frames to the frame rings
+def filter_process(worker, zones, spectra, frame_rings, rate, stop, results):
+    ignore_interrupt()
+    spectrum = np.zeros(spectra.shape, dtype=np.float32)
+    fft_size = (spectra.shape[0] - 1) * 2
+    freq = None
+    frames = 0
+    try:
+        while not stop.is_set():
+            if not spectra.wait(POLL_TIMEOUT):
+                if spectra.is_closed():
+                    break
+                continue
+            (_, capture_time) = spectra.read_latest(spectrum)
+            if freq is None:
+                freq = np.fft.rfftfreq(fft_size, 1 / rate.value)
+
+            for zone, ring in zip(zones, frame_rings):
+                colorVector_normed = zone.get_color_vector(spectrum, freq)
+                ring.write(LedFrame.rgb_to_bytes(zone.colorVectorToRgbValues(colorVector_normed)), capture_time)
+            # All rings of a worker share their condition
+            frame_rings[0].notify()
+            frames += 1
+    finally:
+        for ring in frame_rings:
+            ring.close_writer()
+        results.put(("filter" + str(worker), {"frames": frames, "overruns": spectra.overruns}))
+
+# Publishes the newest frame of each zone
+def output_process(worker, zones, frame_rings, create_comm, stats_interval, stop, results):
+    ignore_interrupt()
+    name = "SoundAnalyzerOutput" + str(worker)
+    stats = LatencyStats(name, stats_interval)
+    frames = [np.zeros((zone.led_count, 3), dtype=np.uint8) for zone in zones]
+    published = 0
+    overruns = 0
+    try:
+        # Connecting is part of the stage, so it still stops and reports, if the broker is never reached
+        comm = create_comm(name)
+        if not wait_connected(comm, frame_rings, stop):
+            return
+        while not stop.is_set():
+            if not frame_rings[0].wait(POLL_TIMEOUT):
+                if frame_rings[0].is_closed():
+                    break
+                continue
+            for zone, ring, frame in zip(zones, frame_rings, frames):
+                record = ring.read_latest(frame)
+                if record is None:
+                    continue
+                zone.publish_rgb(comm, frame, record[1])
+                stats.record("total", time.time() - record[1])
+                published += 1
+
+            skipped = sum(ring.overruns for ring in frame_rings)
+            if skipped != overruns:
+                stats.count("overruns", skipped - overruns)
+                overruns = skipped
+            if stats.due():
+                stats.gauge("outbound", comm.get_outbound_stats())
+            stats.publish_if_due(comm, "stats")
+    finally:
+        results.put(("output" + str(worker), {"frames": published, "overruns": overruns}))
+
+# Runs the pipeline until the audio source is exhausted or Ctrl-C is pressed
+# create_analyzer - creates a SoundAnalyzer without zones in the capture process
+# workers - number of filter/output process pairs, the zones are split across
+# create_comm - creates the connection of an output process from its name, without waiting for it to connect
+# Returns the number of frames and overruns of each stage
+def run_pipeline(create_analyzer, zones, workers = 1, create_comm = create_comm,
+                 fft_size = 1024, stats_interval = 10, slots = RING_SLOTS):
+    workers = max(1, min(workers, len(zones)))
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    rate = multiprocessing.Value('d', 0)
+
+    spectra = SharedRing((fft_size // 2 + 1,), np.float32, slots)
+    rings = [spectra]
+    processes = [multiprocessing.Process(target=capture_process, args=(create_analyzer, spectra, rate, stop, results))]
+    for worker in range(workers):
+        worker_zones = zones[worker::workers]
+        condition = multiprocessing.Condition()
+        frame_rings = [SharedRing((zone.led_count, 3), np.uint8, slots, condition) for zone in worker_zones]
+        rings += frame_rings
+        processes.append(multiprocessing.Process(target=filter_process,
+                                                 args=(worker, worker_zones, spectra, frame_rings, rate, stop, results)))
+        processes.append(multiprocessing.Process(target=output_process,
+                                                 args=(worker, worker_zones, frame_rings, create_comm, stats_interval, stop, results)))
+
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for process in processes:
+            process.join()
+    finally:
+        for ring in rings:
+            ring.release()
+
+    # Stages, which failed before reporting, are missing from the results
+    stage_results = {}
+    for _ in processes:
+        try:
+            (stage, result) = results.get(timeout = POLL_TIMEOUT)
+        except queue.Empty:
+            break
+        stage_results[stage] = result
+    return stage_results
+
+def print_results(results):
+    for stage, result in sorted(results.items()):
+        print(stage + ": " + ", ".join(key + " " + str(value) for key, value in result.items()))
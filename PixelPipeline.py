@@ -0,0 +1,64 @@
+# Converts frames of uint8 rgb values into the packed 24 bit words of the LED strip
+#
+# Gamma, brightness and white balance are applied through 256 entry lookup tables, which are calculated
+# once. The tables already contain the values shifted to their position in the packed word, so a whole
+# frame is converted with three table lookups and two ORs.
+
+import numpy as np
+
+class PixelPipeline:
+    gamma = 1
+    brightness = 1
+    white_balance = (1, 1, 1)
+    # One lookup table per colour channel, mapping uint8 values to their part of the packed word
+    luts = None
+    words = None
+    tmp = None
+
+    # Recalculates the lookup tables, e.g. after changing brightness
+    def update_luts(self):
+        values = np.arange(256, dtype=np.float64) / 255
+        corrected = np.power(values, self.gamma) * self.brightness
+        self.luts = []
+        for shift, balance in zip((16, 8, 0), self.white_balance):
+            lut = np.clip(np.round(corrected * balance * 255), 0, 255).astype(np.uint32)
+            self.luts.append(lut << np.uint32(shift))
+
+    def set_brightness(self, brightness):
+        self.brightness = brightness
+        self.update_luts()
+
+    # Packs an (LED count, 3) uint8 frame into one word per LED
+    # Returns a buffer, which is overwritten by the next call
+    def pack(self, frame):
+        if self.words is None or len(self.words) != len(frame):
+            self.words = np.zeros(len(frame), dtype=np.uint32)
+            self.tmp = np.zeros(len(frame), dtype=np.uint32)
+        np.take(self.luts[0], frame[:, 0], out=self.words)
+        np.take(self.luts[1], frame[:, 1], out=self.tmp)
+        self.words |= self.tmp
+        np.take(self.luts[2], frame[:, 2], out=self.tmp)
+        self.words |= self.tmp
+        return self.words
+
+    # Writes a frame to the pixels of the strip and shows it
+    # This is no bulk transfer on real hardware: rpi_ws281x assigns the slice in Python and calls
+    # ws2811_led_set once per pixel. Only the per pixel Color() call and colour correction are saved,
+    # the words themselves are computed for the whole frame at once. The mock strip takes the slice directly
+    def write(self, strip, frame):
+        words = self.pack(frame)
+        strip.getPixels()[0:len(words)] = words.tolist()
+        strip.show()
+
+    # gamma - exponent of the gamma correction, 1 to disable it
+    # brightness - factor applied to all channels, in [0, 1]
+    # white_balance - factors applied to the red, green and blue channel
+    def __init__(self, gamma = 2.2, brightness = 1, white_balance = (1, 1, 1)):
+        if len(white_balance) != 3:
+            raise ValueError("White balance needs one factor per colour channel: " + str(white_balance))
+        self.gamma = gamma
+        self.brightness = brightness
+        self.white_balance = tuple(white_balance)
+        self.words = None
+        self.tmp = None
+        self.update_luts()
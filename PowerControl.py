@@ -1,18 +1,243 @@
 from Communication import Comm
+import argparse
+import collections
 import configparser
+import json
 import os
+import shlex
+import subprocess
+import threading
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sender', default='codesend {code} 24',
+                        help='Command sending a radio code. {code} is replaced by the code, e.g. a local stand-in script for testing')
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='Maximum number of outlets with a pending command')
+    parser.add_argument('--state_file', default='power_state.json',
+                        help='File the last sent state of every outlet is stored in, to be restored after a restart')
+    parser.add_argument('--refresh_interval', type=float, default=0,
+                        help='Seconds after which the state of every outlet is sent again, in case an outlet missed it. Disabled if 0')
+    return parser.parse_args()
+
+# Last state sent to each outlet, stored in a json file so it survives restarts
+class OutletStates:
+    path = None
+    # State ("on" or "off") and time of the last transmission by outlet number
+    states = {}
+    lock = None
+
+    # Returns the last sent state of an outlet or None, if it is not known
+    def get(self, outlet):
+        with self.lock:
+            entry = self.states.get(outlet)
+            return entry["state"] if entry is not None else None
+
+    # Returns a copy of all known states
+    def get_all(self):
+        with self.lock:
+            return {outlet: dict(entry) for outlet, entry in self.states.items()}
+
+    # Stores the state of an outlet and writes all states to the file
+    def set(self, outlet, state):
+        with self.lock:
+            self.states[outlet] = {"state": state, "time": time.time()}
+            self.save()
+
+    # Writes to a temporary file first, so a crash while writing never leaves a broken file
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path + ".tmp", "w") as state_file:
+                json.dump(self.states, state_file)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as err:
+            print("Failed to save outlet states to " + str(self.path) + ": " + str(err))
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as state_file:
+                states = json.load(state_file)
+        except (OSError, ValueError) as err:
+            print("Ignoring outlet states in " + str(self.path) + ": " + str(err))
+            return
+        self.states = {outlet: entry for outlet, entry in states.items()
+                       if isinstance(entry, dict) and entry.get("state") in ["on", "off"]}
+
+    # path - json file the states are stored in, None to only keep them in memory
+    def __init__(self, path = None):
+        self.path = path
+        self.states = {}
+        self.lock = threading.Lock()
+        self.load()
+
+# Sends radio codes from its own thread, so mqtt callbacks never wait for the transmitter
+#
+# Commands wait in a bounded queue with at most one command per outlet: a new command for an outlet
+# replaces its pending one, as only the latest state matters. If the queue is full, the oldest command is dropped.
+# The sender is run without a shell
+class Transmitter:
+    # Command line of the sender, {code} is replaced by the radio code
+    sender = []
+    queue_size = 0
+    # Pending codes by outlet, in order of arrival
+    pending = None
+    # Last code handed to the transmitter by outlet, whether it is pending, being sent or has been sent
+    submitted = {}
+    condition = None
+    thread = None
+    running = False
+    # True while a code is being sent
+    busy = False
+    # Outlet of the code being sent
+    sending = None
+
+    sent = 0
+    collapsed = 0
+    dropped = 0
+    failed = 0
+
+    # Called from the transmitter thread with outlet and code after a code has been sent successfully
+    on_sent = None
+
+    # True, if a code for the outlet is waiting to be sent
+    def is_pending(self, outlet):
+        with self.condition:
+            return outlet in self.pending
+
+    # Returns the last code submitted for the outlet, including one which is being sent right now
+    # None, if no code has been submitted yet or the last one has been dropped or failed to send
+    def get_submitted(self, outlet):
+        with self.condition:
+            return self.submitted.get(outlet)
+
+    # Queues the code for the outlet, replacing any pending code of this outlet
+    def submit(self, outlet, code):
+        self.submit_batch([(outlet, code)])
+
+    # Queues codes for several outlets at once, e.g. to switch everything off
+    # The worker is only woken up once for the whole batch
+    # replace - False to skip outlets with a code pending or being sent instead of replacing it,
+    #           e.g. to resend stored states without overriding newer commands
+    def submit_batch(self, commands, replace = True):
+        with self.condition:
+            for outlet, code in commands:
+                if not replace and (outlet in self.pending or outlet == self.sending):
+                    continue
+                if outlet in self.pending:
+                    # Superseded command. Keep the position, but send the new code
+                    self.collapsed += 1
+                elif len(self.pending) >= self.queue_size:
+                    (dropped_outlet, _) = self.pending.popitem(last = False)
+                    self.submitted.pop(dropped_outlet, None)
+                    self.dropped += 1
+                    print("Transmitter queue is full, dropped command for outlet " + str(dropped_outlet))
+                self.pending[outlet] = code
+                self.submitted[outlet] = code
+            self.condition.notify()
+
+    # Blocks until all queued codes have been sent or timeout seconds have passed
+    # Returns False on timeout
+    def wait_idle(self, timeout = None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    # Runs the sender for a single code
+    def send(self, code):
+        args = [arg.replace("{code}", str(code)) for arg in self.sender]
+        try:
+            result = subprocess.run(args, stdout = subprocess.DEVNULL, timeout = 10)
+        except (OSError, subprocess.TimeoutExpired) as err:
+            print("Failed to run sender " + str(args) + ": " + str(err))
+            return False
+        if result.returncode != 0:
+            print("Sender " + str(args) + " failed with exit code " + str(result.returncode))
+            return False
+        return True
+
+    # Main loop of the transmitter thread
+    def run(self):
+        while True:
+            with self.condition:
+                self.busy = False
+                self.sending = None
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: self.pending or not self.running)
+                if not self.pending:
+                    return
+                (outlet, code) = self.pending.popitem(last = False)
+                self.busy = True
+                self.sending = outlet
+
+            if self.send(code):
+                self.sent += 1
+                if self.on_sent is not None:
+                    self.on_sent(outlet, code)
+            else:
+                self.failed += 1
+                # The state of the outlet is unknown now, unless a newer code has been submitted meanwhile
+                with self.condition:
+                    if self.submitted.get(outlet) == code and outlet not in self.pending:
+                        del self.submitted[outlet]
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stops the transmitter thread, after sending all queued codes
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    # sender - command line of the sender, {code} is replaced by the radio code
+    # queue_size - maximum number of outlets with a pending code
+    # on_sent - called with outlet and code after a code has been sent successfully
+    def __init__(self, sender = "codesend {code} 24", queue_size = 16, on_sent = None):
+        if queue_size < 1:
+            raise ValueError("Transmitter queue needs a size of at least 1: " + str(queue_size))
+        self.sender = shlex.split(sender)
+        if not self.sender:
+            raise ValueError("Empty sender command")
+        self.queue_size = queue_size
+        self.on_sent = on_sent
+        self.pending = collections.OrderedDict()
+        self.submitted = {}
+        self.condition = threading.Condition()
+        self.running = False
+        self.busy = False
+        self.sending = None
+        self.sent = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.failed = 0
 
 class PowerControl:
 
     comm = None
     config = None
     outlets = {}
+    transmitter = None
+    # Last sent state by outlet number
+    states = None
+    # Outlet number and state switched to by each radio code
+    code_states = {}
+    # Requests skipped, because the outlet already has the requested state
+    skipped = 0
 
     # Handle MQTT requests for power outlet switches
     # power_request is expected to be a dict of the form
     # {"id" : id, "val" : val},
     # where id is a string representing the target
     #  and val is "on" or "off"
+    # Only queues the radio code, which is then sent by the transmitter. Returns immediately
     def handleRequest(self, power_request):
         if "id" in power_request:
             outlet_id = power_request["id"]
@@ -31,44 +256,118 @@ class PowerControl:
             return
 
         if outlet_id in self.outlets:
-            outlet_number = outlets[outlet_id]
+            outlet_number = self.outlets[outlet_id]
         else:
             print("Unkown outlet ID: " + str(outlet_id))
             return
 
-        if outlet_number in self.config.sections():
+        if outlet_number in self.config.sections() and outled_state in self.config[outlet_number]:
             code = self.config[outlet_number][outled_state]
         else:
-            print("Cant find outlet number " + str(outlet_number) + " in given radio_code config")
+            print("Cant find " + str(outled_state) + " code of outlet number " + str(outlet_number) + " in given radio_code config")
+            return
 
-        os.system("codesend " + str(code) +  " 24")
+        # Skip the transmission, if the outlet already has or will have the requested state. Requests are
+        # compared against the last submitted code, as a pending or currently sent code changes the state of
+        # the outlet once it is through. Only if there is none, the last confirmed state is used
+        submitted = self.transmitter.get_submitted(outlet_number)
+        if submitted is not None:
+            redundant = submitted == code
+        else:
+            redundant = self.states.get(outlet_number) == outled_state
+        if redundant:
+            self.skipped += 1
+            return
 
-    def stopAll(self):
+        self.transmitter.submit(outlet_number, code)
 
+    # Called by the transmitter after a code has been sent. Stores and publishes the new state of the outlet
+    def on_sent(self, outlet_number, code):
+        if code not in self.code_states:
+            return
+        (outlet_number, state) = self.code_states[code]
+        self.states.set(outlet_number, state)
+        self.publish_state(outlet_number)
 
-    def __init__(self, configfile, outlet_assignemnt):
-        self.comm = Comm("PowerControl")
-        while not self.comm.connected()
-            pass
-        self.comm.subscribe("power_request", self.handleRequest)
+    # Publishes the state of all outlet ids assigned to the outlet number on their retained state topic
+    def publish_state(self, outlet_number):
+        if self.comm is None:
+            return
+        entry = self.states.get_all().get(outlet_number)
+        if entry is None:
+            return
+        for outlet_id, number in self.outlets.items():
+            if number == outlet_number:
+                msg = {"id": outlet_id, "val": entry["state"], "time": entry["time"]}
+                self.comm.publish("power_state", msg, [outlet_id], retain = True)
+
+    # Publishes the state of every known outlet
+    def publish_states(self):
+        for outlet_number in self.states.get_all():
+            self.publish_state(outlet_number)
 
+    # Sends the last state of every outlet again, e.g. in case an outlet missed a transmission
+    # Outlets with a command on its way are skipped, their stored state is about to be outdated
+    def refresh(self):
+        commands = [(outlet_number, self.config[outlet_number][entry["state"]])
+                    for outlet_number, entry in self.states.get_all().items()
+                    if outlet_number in self.config.sections() and entry["state"] in self.config[outlet_number]]
+        self.transmitter.submit_batch(commands, replace = False)
+
+    # Switches off every outlet in the radio_code config as one batch and waits until all codes have been sent
+    def stopAll(self, timeout = 30):
+        commands = [(outlet_number, self.config[outlet_number]["off"])
+                    for outlet_number in self.config.sections() if "off" in self.config[outlet_number]]
+        self.transmitter.submit_batch(commands)
+        if not self.transmitter.wait_idle(timeout):
+            print("Timeout while switching off all outlets")
+
+    # sender - command line sending a radio code, {code} is replaced by the code
+    # state_file - json file the outlet states are stored in, None to only keep them in memory
+    def __init__(self, configfile, outlet_assignemnt, sender = "codesend {code} 24", queue_size = 16,
+                 state_file = "power_state.json"):
         self.config = configparser.ConfigParser()
         self.config.read(configfile)
 
+        self.code_states = {}
+        for outlet_number in self.config.sections():
+            for state in ["on", "off"]:
+                if state in self.config[outlet_number]:
+                    self.code_states[self.config[outlet_number][state]] = (outlet_number, state)
+        self.states = OutletStates(state_file)
+        self.skipped = 0
+
+        self.outlets = {}
         outlets = configparser.ConfigParser()
         outlets.read(outlet_assignemnt)
         for sec in outlets.sections():
             for key in outlets[sec]:
                 self.outlets[key] = outlets[sec][key]
 
+        self.transmitter = Transmitter(sender, queue_size, self.on_sent)
+        self.transmitter.start()
+
+        self.comm = Comm("PowerControl")
+        print("Wait for MQTT to connect to broker...")
+        self.comm.wait_connected()
+        self.comm.subscribe("power_request", self.handleRequest)
+
+        # States are published again after every reconnect, as changes while the broker was unreachable have
+        # been dropped and a restarted broker may have lost the retained ones. This includes restored states at startup
+        self.comm.add_connect_callback(self.publish_states)
 
 
 if __name__ == "__main__":
-    pc = PowerControl("cfg/radio_codes.cfg", "cfg/outlets.cfg")
+    args = parse_args()
+    pc = PowerControl("cfg/radio_codes.cfg", "cfg/outlets.cfg", args.sender, args.queue_size, args.state_file)
     print('Press Ctrl-C to quit.')
     try:
         while True:
-            time.sleep(100)
-            pass
+            if args.refresh_interval > 0:
+                time.sleep(args.refresh_interval)
+                pc.refresh()
+            else:
+                time.sleep(100)
     except KeyboardInterrupt:
         pc.stopAll()
+        pc.transmitter.stop()
@@ -0,0 +1,236 @@
+# Preallocated ring buffer for passing samples from one producer thread to one consumer thread
+#
+# The producer (e.g. the PyAudio stream callback) only ever advances the write counter and the
+# consumer only ever advances its read counter, so neither side has to take a lock. The consumer
+# always pulls the newest window of samples. Samples the consumer never got to see, because it was too
+# slow, are counted as overflow. Reads which could not be served with fresh samples are counted as underrun.
+
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+class RingBuffer:
+    buffer = None
+    capacity = 0
+    # Total number of samples written/read since creation. Only ever increase
+    written = 0
+    read_pos = 0
+
+    overflows = 0
+    underruns = 0
+
+    new_data = None
+
+    # Appends samples to the buffer. Only to be called from the producer thread
+    def write(self, samples):
+        n = len(samples)
+        if n > self.capacity:
+            samples = samples[-self.capacity:]
+            self.written += n - self.capacity
+            n = self.capacity
+
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+
+        # Publish samples only after they have been copied
+        self.written += n
+        self.new_data.set()
+
+    # Number of samples written, which have not been read yet
+    def available(self):
+        return self.written - self.read_pos
+
+    # Blocks until at least count unread samples are available
+    # Returns False and counts an underrun, if timeout is reached before
+    def wait(self, count, timeout = None):
+        while self.available() < count:
+            self.new_data.clear()
+            # Recheck, as the producer could have written in between
+            if self.available() >= count:
+                break
+            if not self.new_data.wait(timeout):
+                self.underruns += 1
+                return False
+        return True
+
+    # Copies the newest count samples into out (or a new array) and marks everything up to them as read
+    def read_latest(self, count, out = None):
+        if count > self.capacity:
+            raise ValueError("Can not read " + str(count) + " samples from ring buffer of size " + str(self.capacity))
+        if out is None:
+            out = np.empty(count, dtype=self.buffer.dtype)
+
+        while True:
+            end = self.written
+            start = end - count
+            if start < 0:
+                # Not enough samples recorded yet, pad with silence
+                self.underruns += 1
+                out[:-start] = 0
+                out[-start:] = self.buffer[:end]
+                break
+
+            begin = start % self.capacity
+            first = min(count, self.capacity - begin)
+            out[:first] = self.buffer[begin:begin + first]
+            out[first:] = self.buffer[:count - first]
+
+            # If the producer wrapped around into the window while copying, the copy is torn. Retry
+            if self.written - start <= self.capacity:
+                break
+
+        if start > self.read_pos:
+            self.overflows += start - self.read_pos
+        self.read_pos = max(self.read_pos, end)
+        return out
+
+    def __init__(self, capacity, dtype = np.float32):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.written = 0
+        self.read_pos = 0
+        self.overflows = 0
+        self.underruns = 0
+        self.new_data = threading.Event()
+
+# Ring of fixed size records (e.g. spectra or LED frames) in shared memory, passed from one producer
+# process to any number of consumer processes
+#
+# Every record is stored with a sequence number and a timestamp. The producer marks a slot as being written
+# before overwriting it and stores the sequence number only once the record is complete, so a consumer can
+# detect torn reads and retry. Consumers always read the newest record. Records they skipped, because they
+# were too slow, are detected by the gap in sequence numbers and counted as overruns.
+# The ring has to be passed to the consumer processes when they are created
+class SharedRing:
+    shm = None
+    # True for the process, which created the shared memory and has to remove it
+    owner = False
+    slots = 0
+    shape = None
+    dtype = None
+    # Signals new records to waiting consumers. Shared by all rings written together
+    condition = None
+
+    # Number of the next record to write and 1 once the producer has finished
+    header = None
+    # Sequence number of the record in each slot, -1 while being written
+    slot_seqs = None
+    times = None
+    records = None
+
+    # Sequence number of the next record to read and number of records skipped by this consumer
+    read_seq = 0
+    overruns = 0
+
+    # Writes a record with its timestamp. Only to be called from the producer
+    # Consumers are not woken up until notify is called
+    def write(self, record, timestamp):
+        seq = int(self.header[0])
+        slot = seq % self.slots
+        self.slot_seqs[slot] = -1
+        self.records[slot] = record
+        self.times[slot] = timestamp
+        self.slot_seqs[slot] = seq
+        self.header[0] = seq + 1
+
+    # Wakes up all consumers waiting on the condition of this ring
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    # Marks the end of the stream, e.g. when the audio source is exhausted
+    def close_writer(self):
+        self.header[1] = 1
+        self.notify()
+
+    def is_closed(self):
+        return self.header[1] != 0
+
+    # True, if a record has been written, which this consumer has not read yet
+    def available(self):
+        return self.header[0] > self.read_seq
+
+    # Blocks until a new record is available, the producer has finished or timeout seconds have passed
+    # Returns True, if a new record is available
+    def wait(self, timeout = None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.available() or self.is_closed(), timeout)
+        return self.available()
+
+    # Copies the newest record into out
+    # Returns its sequence number and timestamp, or None if there is no new record
+    def read_latest(self, out):
+        while True:
+            end = int(self.header[0])
+            if end <= self.read_seq:
+                return None
+            seq = end - 1
+            slot = seq % self.slots
+            if self.slot_seqs[slot] != seq:
+                # Overwritten since reading the header. Retry with the newer record
+                continue
+            out[:] = self.records[slot]
+            timestamp = float(self.times[slot])
+            # If the producer wrapped around into the slot while copying, the copy is torn. Retry
+            if self.slot_seqs[slot] == seq:
+                break
+
+        self.overruns += seq - self.read_seq
+        self.read_seq = seq + 1
+        return seq, timestamp
+
+    # Unmaps the shared memory. The creating process also removes it
+    def release(self):
+        self.header = self.slot_seqs = self.times = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    # Creates the numpy views on the shared memory
+    def map_buffers(self):
+        offset = 0
+        self.header = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += self.header.nbytes
+        self.slot_seqs = np.ndarray(self.slots, dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += self.slot_seqs.nbytes
+        self.times = np.ndarray(self.slots, dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += self.times.nbytes
+        self.records = np.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=offset)
+
+    # Size of the shared memory needed for the given dimensions
+    @staticmethod
+    def size(slots, shape, dtype):
+        return 8 * (2 + 2 * slots) + slots * int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    # When passed to a process, which is not forked, the ring is attached by the name of the shared memory
+    def __getstate__(self):
+        return (self.shm.name, self.slots, self.shape, self.dtype.str, self.condition, self.read_seq)
+
+    def __setstate__(self, state):
+        (name, self.slots, self.shape, dtype, self.condition, self.read_seq) = state
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        self.overruns = 0
+        self.map_buffers()
+
+    # shape - shape of a single record, e.g. (bins,) for spectra or (LED count, 3) for frames
+    # slots - number of records kept
+    # condition - multiprocessing.Condition used to wait for new records. Created if None
+    def __init__(self, shape, dtype, slots = 8, condition = None):
+        if slots < 2:
+            raise ValueError("Shared ring needs at least 2 slots: " + str(slots))
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.condition = condition if condition is not None else multiprocessing.Condition()
+        self.shm = shared_memory.SharedMemory(create=True, size=SharedRing.size(slots, self.shape, self.dtype))
+        self.owner = True
+        self.map_buffers()
+        self.header[:] = 0
+        self.slot_seqs[:] = -1
+        self.read_seq = 0
+        self.overruns = 0
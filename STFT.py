@@ -0,0 +1,67 @@
+# Short time fourier transform over a stream of audio samples
+#
+# Analyzes overlapping frames of fft_size samples, advancing by hop_size samples per frame.
+# All work buffers are float32 and allocated once, every step operates in place on them.
+
+import numpy as np
+from scipy import fft
+from scipy import signal
+
+class STFT:
+    fft_size = 0
+    hop_size = 0
+    rate = 0
+
+    window = None
+    # Scaling of the FFT magnitude to full scale of 16 bit samples
+    scale = 1
+
+    # Newest fft_size samples. Can be written directly, e.g. by RingBuffer.read_latest
+    frame = None
+    windowed = None
+    # Amplitudes in dBFS of the last computed frame
+    magnitude = None
+    freq = None
+
+    # Appends hop_size (or less) new samples to the frame, discarding the oldest ones
+    def push(self, samples):
+        n = len(samples)
+        self.frame[:-n] = self.frame[n:]
+        self.frame[-n:] = samples
+
+    # Calculates the amplitude spectrum of the current frame in dBFS
+    # Returns the magnitude buffer, which is overwritten by the next call
+    def compute(self):
+        # if you take an FFT of a chunk of audio, the edges will look like
+        # super high frequency cutoffs. Applying a window tapers the edges
+        # of each end of the chunk down to zero.
+        np.multiply(self.frame, self.window, out=self.windowed)
+        spectrum = fft.rfft(self.windowed, overwrite_x=True)
+
+        # Scale the magnitude of FFT by window and factor of 2,
+        # because we are using half of FFT spectrum.
+        np.abs(spectrum, out=self.magnitude)
+        self.magnitude *= self.scale
+        # Convert to dBFS. Clip silence to avoid log of 0
+        np.maximum(self.magnitude, 1e-10, out=self.magnitude)
+        np.log10(self.magnitude, out=self.magnitude)
+        self.magnitude *= 20
+        return self.magnitude
+
+    # fft_size - number of samples per analyzed frame
+    # hop_size - number of new samples between two frames. Frames overlap if smaller than fft_size
+    # window - any window known to scipy.signal.get_window, e.g. hann, hamming, blackman
+    def __init__(self, rate, fft_size = 1024, hop_size = 1024, window = "hann"):
+        if hop_size < 1 or hop_size > fft_size:
+            raise ValueError("Hop size has to be between 1 and the FFT size " + str(fft_size) + ": " + str(hop_size))
+        self.fft_size = fft_size
+        self.hop_size = hop_size
+        self.rate = rate
+
+        self.window = signal.get_window(window, fft_size).astype(np.float32)
+        self.scale = 2 / np.sum(self.window) / 32768
+
+        self.frame = np.zeros(fft_size, dtype=np.float32)
+        self.windowed = np.zeros(fft_size, dtype=np.float32)
+        self.magnitude = np.zeros(fft_size // 2 + 1, dtype=np.float32)
+        self.freq = np.fft.rfftfreq(fft_size, 1 / rate)
@@ -0,0 +1,94 @@
+# Smoothing of consecutive spectra, in order to calm down the LED output
+#
+# Every smoother keeps its state in preallocated arrays and updates them in place,
+# so the cost per frame is O(bins), independent of the smoothing window.
+# update returns the output buffer, which is overwritten by the next call
+
+import numpy as np
+
+# Passes spectra on unchanged
+class NoSmoothing:
+    def update(self, spectrum):
+        return spectrum
+
+# Moving average over the last window spectra, using a running sum
+class MovingAverage:
+    window = 0
+    history = None
+    running_sum = None
+    output = None
+    # Number of spectra added so far
+    count = 0
+
+    # Recalculate the running sum from scratch every x updates to get rid of accumulated rounding errors
+    resync_interval = 1000
+
+    def update(self, spectrum):
+        index = self.count % self.window
+        if self.count >= self.window:
+            self.running_sum -= self.history[index]
+        self.running_sum += spectrum
+        self.history[index] = spectrum
+        self.count += 1
+
+        if self.count % self.resync_interval == 0:
+            np.sum(self.history, axis=0, out=self.running_sum)
+
+        np.multiply(self.running_sum, 1 / min(self.count, self.window), out=self.output, casting='unsafe')
+        return self.output
+
+    def __init__(self, window, bins):
+        if window < 1:
+            raise ValueError("Smoothing window has to be at least 1: " + str(window))
+        self.window = window
+        self.history = np.zeros((window, bins), dtype=np.float32)
+        self.running_sum = np.zeros(bins, dtype=np.float64)
+        self.output = np.zeros(bins, dtype=np.float32)
+        self.count = 0
+
+# Exponential smoothing, with separate coefficients for rising (attack) and falling (release) amplitudes
+# A coefficient of 1 follows the input immediately, smaller values react slower
+class AttackReleaseSmoother:
+    attack = 1
+    release = 1
+    output = None
+    initialized = False
+
+    diff = None
+    coeff = None
+    rising = None
+
+    def update(self, spectrum):
+        if not self.initialized:
+            self.output[:] = spectrum
+            self.initialized = True
+            return self.output
+
+        np.subtract(spectrum, self.output, out=self.diff)
+        np.greater(self.diff, 0, out=self.rising)
+        self.coeff.fill(self.release)
+        np.copyto(self.coeff, self.attack, where=self.rising)
+        self.diff *= self.coeff
+        self.output += self.diff
+        return self.output
+
+    def __init__(self, attack, release, bins):
+        if not 0 < attack <= 1 or not 0 < release <= 1:
+            raise ValueError("Attack and release have to be in (0, 1]: " + str(attack) + ", " + str(release))
+        self.attack = attack
+        self.release = release
+        self.output = np.zeros(bins, dtype=np.float32)
+        self.initialized = False
+        self.diff = np.zeros(bins, dtype=np.float32)
+        self.coeff = np.zeros(bins, dtype=np.float32)
+        self.rising = np.zeros(bins, dtype=bool)
+
+# Creates the smoother selected by name: average, attack_release or none
+def create_smoother(name, bins, window = 3, attack = 1, release = 1):
+    if name == "average":
+        return MovingAverage(window, bins)
+    elif name == "attack_release":
+        return AttackReleaseSmoother(attack, release, bins)
+    elif name == "none":
+        return NoSmoothing()
+    raise ValueError("Unknown smoothing " + str(name) + ". Known are average, attack_release and none")
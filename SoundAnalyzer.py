@@ -4,16 +4,22 @@
 # Apply predefined filters to map audio frequency amplitudes to LED color strip
 
 import argparse
+import functools
+import sys
 import time
-import pyaudio
 import struct
 import numpy as np
 import matplotlib.pyplot as plt
-import collections
-import threading
-from scipy import signal
-from Filter import UniformFilter
-from Communication import Comm
+import multiprocessing
+from Filter import UniformFilter, FilterBank
+from Communication import Comm, load_topics
+import AudioSource
+from STFT import STFT
+import Smoothing
+import NoiseProfile
+from LatencyStats import LatencyStats
+from Zone import Zone, load_zones, create_spectrum_zone, check_zone_topics
+import Pipeline
 
 # Number of LED/RGB Points
 LED_count = 100
@@ -29,231 +35,392 @@ filters = [blueFilter, greenFilter, yellowFilter, redFilter]
 # Determines how many of the last results are averaged in order to smooth input
 input_smooth_window = 3
 
+
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--source', choices=['pyaudio', 'wav', 'tone'], default='pyaudio',
+                        help='Analyze a live pyaudio device, a WAV file or synthetic tones')
     parser.add_argument('--device', type=int, default=None, dest='device',
-                        help='pyaudio (portaudio) device index')
+                        help='pyaudio (portaudio) device index. Uses the default input device if not set')
+    parser.add_argument('--file', default=None,
+                        help='WAV file analyzed by the wav source')
+    parser.add_argument('--loop', action='store_true',
+                        help='Restart the WAV file once its end has been reached')
+    parser.add_argument('--tone_freqs', type=float, nargs='+', default=[100, 440, 2000],
+                        help='Frequencies in Hz generated by the tone source')
+    parser.add_argument('--rate', type=int, default=44100,
+                        help='Sample rate of the tone source')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='Seconds of audio generated by the tone source. Endless if not set')
     parser.add_argument('--viz', action='store_true')
-    parser.add_argument('--remove_mic_noise', action='store_true')
+    parser.add_argument('--viz_fps', type=float, default=20,
+                        help='Maximum frame rate of the visualization')
+    parser.add_argument('--remove_mic_noise', action='store_true',
+                        help='Subtract the microphone noise profile. Calibrates it first, if none is stored yet')
+    parser.add_argument('--noise_duration', type=float, default=5,
+                        help='Seconds of silence recorded to calibrate the microphone noise')
+    parser.add_argument('--noise_dir', default='noise_profiles',
+                        help='Directory the microphone noise profiles are stored in')
+    parser.add_argument('--recalibrate', action='store_true',
+                        help='Calibrate the microphone noise again, even if a profile is stored')
+    parser.add_argument('--fft_size', type=int, default=1024,
+                        help='Number of samples per analyzed frame')
+    parser.add_argument('--hop_size', type=int, default=1024,
+                        help='Number of new samples between two analyzed frames. Frames overlap if smaller than fft_size')
+    parser.add_argument('--window', default='hann',
+                        help='FFT window, any window known to scipy.signal.get_window')
+    parser.add_argument('--smoothing', choices=['average', 'attack_release', 'none'], default='average',
+                        help='Smooth spectra by a moving average or by exponential attack/release')
+    parser.add_argument('--smooth_window', type=int, default=input_smooth_window,
+                        help='Number of spectra averaged by the moving average')
+    parser.add_argument('--attack', type=float, default=0.5,
+                        help='Attack/release smoothing coefficient for rising amplitudes, in (0, 1]')
+    parser.add_argument('--release', type=float, default=0.1,
+                        help='Attack/release smoothing coefficient for falling amplitudes, in (0, 1]')
+    parser.add_argument('--capture', choices=['callback', 'blocking'], default='callback',
+                        help='Capture pyaudio from a stream callback into a ring buffer, or read it blocking in the analysis loop')
+    parser.add_argument('--stats_interval', type=float, default=10,
+                        help='Seconds between publishing latency statistics on the stats topic')
+    parser.add_argument('--publish_mode', choices=['frame', 'led'], default='frame',
+                        help='Publish the whole LED chain as one binary frame or one json message per LED')
+    parser.add_argument('--keyframe_interval', type=int, default=30,
+                        help='In frame mode, send a full frame every x frames and only changed LEDs in between')
+    parser.add_argument('--zones', default=None,
+                        help='Config file of the LED zones driven from the shared spectrum, e.g. cfg/zones.cfg. '
+                             'Drives a single zone with the default filters if not set')
+    parser.add_argument('--mapping', choices=['segments', 'spectrum'], default='segments',
+                        help='Without --zones: map the default filters onto colour segments, or show a spectrum bar with one band per LED')
+    parser.add_argument('--bands', type=int, default=None,
+                        help='Number of bands of the spectrum bar. One band per LED if not set')
+    parser.add_argument('--band_scale', choices=['log', 'mel'], default='log',
+                        help='Frequency scale the bands of the spectrum bar are evenly spaced on')
+    parser.add_argument('--fmin', type=float, default=40,
+                        help='Lowest frequency of the spectrum bar')
+    parser.add_argument('--fmax', type=float, default=12000,
+                        help='Highest frequency of the spectrum bar')
+    parser.add_argument('--pipeline_workers', type=int, default=0,
+                        help='Run capture, filtering and publishing in separate processes, with the zones split '
+                             'across this many filtering and publishing processes. Runs in a single process if 0')
     return parser.parse_args()
 
+# Draws spectrum and LED output. Runs in its own process, so slow drawing never stalls the analysis
+# Polls the shared buffers of the Vizualizer at up to fps frames per second and only draws the newest frame
+def render_viz(rate, freq, led_count, fps, spectrum, rgb, seq, lock):
+    plt.ion()
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.set_xlim(10, rate)
+    ax.set_xscale('log')
+    ax.set_ylim(-50, 100)
+    ax.set_title("Fast Fourier Transform")
+
+    led = fig.add_subplot(222)
+    led.set_xlim(0, led_count)
+    led.set_ylim(0, 2)
+    led.set_title("Led Output")
+
+    # Persistent artists, which are only updated with new data
+    spectrum_local = np.zeros(len(freq), dtype=np.float32)
+    rgb_local = np.zeros((led_count, 3), dtype=np.float32)
+    line, = ax.plot(freq, spectrum_local, 'r-', animated=True)
+    leds = led.scatter(np.arange(led_count), np.ones(led_count), c=rgb_local, animated=True)
+
+    plt.show(block=False)
+    fig.canvas.draw()
+    ax_background = fig.canvas.copy_from_bbox(ax.bbox)
+    led_background = fig.canvas.copy_from_bbox(led.bbox)
+
+    drawn_seq = 0
+    while plt.fignum_exists(fig.number):
+        if seq.value != drawn_seq:
+            with lock:
+                drawn_seq = seq.value
+                spectrum_local[:] = np.frombuffer(spectrum, dtype=np.float32)
+                rgb_local[:] = np.frombuffer(rgb, dtype=np.float32).reshape(led_count, 3)
+
+            fig.canvas.restore_region(ax_background)
+            fig.canvas.restore_region(led_background)
+            line.set_ydata(spectrum_local)
+            ax.draw_artist(line)
+            leds.set_facecolor(rgb_local)
+            led.draw_artist(leds)
+            fig.canvas.blit(ax.bbox)
+            fig.canvas.blit(led.bbox)
+
+        fig.canvas.flush_events()
+        time.sleep(1 / fps)
+
+# Hands the newest spectrum and LED colours over to the render process (see render_viz)
+# Only the latest frame is kept. If the renderer is busy copying it, the frame is dropped
+# instead of waiting for it
 class Vizualizer:
-    fig = None
-    ax = None
-    led = None
-    line = None
-    ax_background = None
-    led_background = None
+    process = None
+    spectrum = None
+    rgb = None
+    seq = None
+    lock = None
+    # Frames dropped, because the renderer was reading the previous one
+    dropped = 0
 
     def update_viz(self, freq, result, rgb_values):
-        self.fig.canvas.restore_region(self.led_background)
-        self.fig.canvas.restore_region(self.ax_background)
-        if self.line is None:
-            self.line, = self.ax.plot(freq, result, 'r-')
-        else:
-            self.line.set_ydata(result)
-            self.line.set_xdata(freq)
-            self.ax.draw_artist(self.line)
-
-        self.led.cla()
-        for i, rgb in enumerate(rgb_values):
-            self.led.scatter(i, 1, color=rgb)
-
-        self.fig.canvas.blit(self.ax.bbox)
-        self.fig.canvas.blit(self.led.bbox)
-
-        self.fig.canvas.flush_events()
-
-    def __init__(self, rate):
-        plt.ion()
-        self.fig = plt.figure()
-        self.ax = self.fig.add_subplot(111)
-        self.ax.set_xlim(10, rate)
-        self.ax.set_xscale('log')
-        self.ax.set_ylim(-50, 100)
-        self.ax.set_title("Fast Fourier Transform")
-
-        self.led = self.fig.add_subplot(222)
-        self.led.set_xlim(0, LED_count)
-        self.led.set_ylim(0, 2)
-        self.led.set_title("Led Output")
-
-        self.ax_background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
-        self.led_background = self.fig.canvas.copy_from_bbox(self.led.bbox)
+        if not self.lock.acquire(block=False):
+            self.dropped += 1
+            return
+        try:
+            np.frombuffer(self.spectrum, dtype=np.float32)[:] = result
+            np.frombuffer(self.rgb, dtype=np.float32)[:] = np.ravel(rgb_values)
+            self.seq.value += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def __init__(self, rate, freq, led_count = LED_count, fps = 20):
+        self.spectrum = multiprocessing.RawArray('f', len(freq))
+        self.rgb = multiprocessing.RawArray('f', led_count * 3)
+        self.seq = multiprocessing.RawValue('L', 0)
+        self.lock = multiprocessing.Lock()
+        self.dropped = 0
+
+        self.process = multiprocessing.Process(target=render_viz,
+                                               args=(rate, np.asarray(freq), led_count, fps,
+                                                     self.spectrum, self.rgb, self.seq, self.lock),
+                                               daemon=True)
+        self.process.start()
+
+# Creates an analyzer, which only calculates spectra of the audio source selected by the command line arguments
+# Used by the capture process of the pipeline mode (see Pipeline.py)
+def create_spectrum_analyzer(args):
+    source = create_audio_source(args)
+    sa = SoundAnalyzer(source, False, args.publish_mode, args.keyframe_interval,
+                       args.fft_size, args.hop_size, args.window,
+                       args.smoothing, args.smooth_window, args.attack, args.release,
+                       stats_interval = args.stats_interval, zones = [])
+    if args.remove_mic_noise:
+        sa.load_mic_noise(args.noise_dir, args.noise_duration, args.recalibrate)
+    return sa
+
+# Creates the audio source selected by the command line arguments
+def create_audio_source(args):
+    if args.source == "wav":
+        if args.file is None:
+            raise Exception("The wav source needs a --file")
+        return AudioSource.WavFileSource(args.file, args.loop)
+    elif args.source == "tone":
+        return AudioSource.ToneSource(args.tone_freqs, args.rate, duration = args.duration)
+    return AudioSource.PyAudioSource(args.device, args.fft_size, args.hop_size, args.capture)
 
 class SoundAnalyzer:
-    stream = None
-    chunk = None
+    source = None
+    # Number of analyzed frames and time of the first frame, to calculate the achieved frame rate
+    frame_count = 0
+    start_time = None
 
-    freq_buffer = None
-    window = np.hanning(0)
-    fft_freq = []
+    smoother = None
+    stft = None
 
-    filters = []
+    # LED chains, each mapping the spectrum with its own filters (see Zone.py)
+    zones = []
 
-    mic_noise_fft = None
-    mic_noise_count = 0
+    # Mean microphone noise per frequency, subtracted from every spectrum
+    mic_noise_fft = 0
 
     comm = None
-
-    def publish_rgb(self, rgb_values):
-        for i,rgb in enumerate(rgb_values):
-            self.comm.publish("rgb_values", {"id": i, "rgb": rgb})
-
-    def colorVectorToRgbValues(self, colorVector):
-        result = []
-        # Check if colorVector is unitsized, which is needed to match it to the LED chain
-        # Deal with floating point errors by checking against threshold
-        if abs(sum(colorVector) - 1.0) > 0.00001:
-            raise ValueError("Sum of filter responses needs to be == 1: " + str(colorVector) + " -> " + str(sum(colorVector)))
-
-        for i in range(LED_count):
-            j = 0
-            # Search for Color range this LED belongs to
-            while (i / LED_count) > sum(colorVector[:(j+1)]):
-                j = j+1
-                if j >= len(filters):
-                    raise ValueError("For LED " + str(i/LED_count) + " no filter response " + str(colorVector))
-            result.append(filters[j].colour)
-
-        return result
+    publish_mode = "frame"
+    # Per stage latencies, published periodically on the stats topic
+    stats = None
+    # Time at which the audio of the current frame became available for analysis
+    fill_time = 0
 
     # Reads sound data from input stream, calculates frequencies and amplitudes
     # Discards a subset of frequencies (e.g. every second), in order to reduce
     # complexity
     def collect_values(self):
-        data = self.stream.read(self.CHUNK, exception_on_overflow=False)
-
-        data = np.frombuffer(data, np.int16)
-
-        if self.CHANNELS == 2:
-            # data has 2 bytes per channel
-            # pull out the even values, just using left channel
-            data = np.array(data[::2])
-
-        # if you take an FFT of a chunk of audio, the edges will look like
-        # super high frequency cutoffs. Applying a window tapers the edges
-        # of each end of the chunk down to zero.
-        if len(data) != len(self.window):
-            self.window = np.hanning(len(data)).astype(np.float32)
-
-        data = data * self.window
-        fft_result = np.fft.rfft(data)
-
-        # If len of amplitudes does not match the stored frequency list, recalculate frequencies
-        if len(fft_result) != len(self.fft_freq):
-            self.fft_freq = np.fft.rfftfreq(self.CHUNK, 1 / self.RATE)
-
-        # Scale the magnitude of FFT by window and factor of 2,
-        # because we are using half of FFT spectrum.
-        fft_result = np.abs(fft_result) * 2 / np.sum(self.window)
-        # Convert to dBFS
-        fft_result = 20 * np.log10(fft_result / 32768)
-
-        # Smooth result by averaging over last x results
-        self.freq_buffer.append(fft_result)
-        fft_result = np.average(self.freq_buffer, axis=0)
-
-        return fft_result, self.fft_freq
-
-    def calc_mic_noise(self):
-        fft_result, _ = self.collect_values()
-        if self.mic_noise_count == 0:
-            # First spectrum to calculate mic noise
-            self.mic_noise_fft = fft_result
-            self.mic_noise_count += 1
+        # Advance the analyzed frame by one hop of new audio
+        if not self.source.fill(self.stft):
+            return None, self.stft.freq
+        self.fill_time = time.time()
+
+        fft_result = self.stft.compute()
+
+        # Smooth result with the previous results
+        fft_result = self.smoother.update(fft_result)
+
+        return fft_result, self.stft.freq
+
+    # Loads the microphone noise profile of the current source, sample rate and FFT size from directory.
+    # If there is none (or recalibrate is set), a new profile is measured for duration seconds and saved
+    def load_mic_noise(self, directory, duration, recalibrate = False):
+        bins = len(self.stft.freq)
+        path = NoiseProfile.profile_path(directory, self.source.name, self.RATE, self.stft.fft_size)
+
+        profile = None
+        if not recalibrate:
+            profile = NoiseProfile.load_profile(path, bins)
+
+        if profile is None:
+            frames = max(1, int(duration * self.RATE / self.stft.hop_size))
+            print("Collecting microphone noise for " + str(duration) + "s. There should be no sound playing during this.")
+            profile = NoiseProfile.calibrate(lambda: self.collect_values()[0], frames, bins)
+            profile.save(path)
+            print("Saved microphone noise profile to " + str(path))
         else:
-            # Iterative averaging
-            self.mic_noise_count += 1
-            tmp = np.subtract(fft_result, self.mic_noise_fft)
-            tmp = tmp / self.mic_noise_count
-            self.mic_noise_fft = np.add(self.mic_noise_fft, tmp)
+            print("Loaded microphone noise profile from " + str(path))
 
-    def run(self):
+        self.mic_noise_fft = profile.mean
+
+    # Calculates the spectrum of the next frame of audio, without microphone noise and with all amplitudes >= 0
+    # Returns None instead of the amplitudes, if the audio source is exhausted
+    def analyze(self):
         fft_result, fft_freq = self.collect_values()
+        if fft_result is None:
+            return None, fft_freq
+
         # Remove previous calculated mic noise (is 0, if feature is disabled)
         fft_result = fft_result - self.mic_noise_fft
 
         # Move amplitudes relative to smalles amplitude (so every amplitude >= 0)
         fft_result = fft_result - min(fft_result)
+        return fft_result, fft_freq
 
-        colorVector = []
-        # Calculate response of each filter
-        for f in filters:
-            colorVector.append(f.get_filtered_result(fft_result, fft_freq))
-        # Resize color vector to unit size -> Sum should be one, in order to match LED colors
-        colorVectorLength = sum(colorVector)
-        colorVector_normed = colorVector / colorVectorLength
-
-        rgb_values = self.colorVectorToRgbValues(colorVector_normed)
-
-        self.publish_rgb(rgb_values)
+    # Analyzes the next frame of audio and publishes the resulting LED colours
+    # Returns False, if the audio source is exhausted
+    def run(self):
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        fft_result, fft_freq = self.analyze()
+        if fft_result is None:
+            return False
+        fft_time = time.time()
+        capture_time = self.source.capture_time
+
+        # Every zone maps the same spectrum with its own filters onto its LEDs
+        # Stage latencies are summed over all zones
+        filter_duration = map_duration = publish_duration = 0
+        for zone in self.zones:
+            zone_start = time.time()
+            # Calculate normed response of each filter
+            colorVector_normed = zone.get_color_vector(fft_result, fft_freq)
+            filter_time = time.time()
+
+            rgb_values = zone.colorVectorToRgbValues(colorVector_normed)
+            map_time = time.time()
+
+            zone.publish_rgb(self.comm, rgb_values, capture_time)
+            publish_time = time.time()
+
+            filter_duration += filter_time - zone_start
+            map_duration += map_time - filter_time
+            publish_duration += publish_time - map_time
+            if zone is self.zones[0]:
+                viz_rgb_values = rgb_values
+
+        self.stats.record("capture", self.fill_time - capture_time)
+        self.stats.record("fft", fft_time - self.fill_time)
+        self.stats.record("filter", filter_duration)
+        self.stats.record("map", map_duration)
+        self.stats.record("publish", publish_duration)
+        self.stats.record("total", publish_time - capture_time)
+        self.stats.count("frames")
+        if self.stats.due():
+            self.stats.gauge("outbound", self.comm.get_outbound_stats())
+        self.stats.publish_if_due(self.comm, "stats")
 
         if self.viz != None:
-            self.viz.update_viz(fft_freq, fft_result, rgb_values)
-
-    # Initialize audio stream. If no device argument is passed, grab all audio devices and let the user select
+            self.viz.update_viz(fft_freq, fft_result, viz_rgb_values)
+
+        self.source.report_stats()
+        self.frame_count += 1
+        return True
+
+    # Prints the achieved frame rate, and for non realtime sources how much faster than realtime that is
+    def report_frame_rate(self):
+        if self.start_time is None:
+            return
+        elapsed = time.time() - self.start_time
+        fps = self.frame_count / elapsed if elapsed > 0 else 0
+        realtime_fps = self.source.rate / self.stft.hop_size
+        print("Analyzed {} frames in {:.2f}s: {:.1f} fps ({:.1f}x realtime)".format(
+            self.frame_count, elapsed, fps, fps / realtime_fps))
+
+    # Analyze audio of the given source (see AudioSource.py)
     # If visualization is activated, create the empty graph windows
-    def __init__(self, viz):
-        self.comm = Comm("SoundAnalyzer")
-        while not self.comm.is_connected():
-            pass
-
-        mic = pyaudio.PyAudio()
-
-        if args.device == None:
-            # Print all available sound devices
-            numdevices = mic.get_host_api_info_by_index(0).get('deviceCount')
-            for i in range(0, numdevices):
-                if (mic.get_device_info_by_host_api_device_index(0, i).get('maxInputChannels')) > 0:
-                    print(
-                        "Input Device id ",
-                        i,
-                        " - ",
-                        mic.get_device_info_by_host_api_device_index(0, i))
-            # Ask for user input to select an audio device
-            device_id = int(input("Please select microphone device: "))
-        else:
-            device_id = int(args.device)
-
-        device_info = mic.get_device_info_by_index(device_id)
-
-        FORMAT = pyaudio.paInt16
-        self.CHANNELS = device_info["maxInputChannels"] if (
-            device_info["maxOutputChannels"] < device_info["maxInputChannels"]) else device_info["maxOutputChannels"]
-        self.RATE = int(device_info["defaultSampleRate"])
-        self.CHUNK = 1024
-
-        # Open audio stream with default settings
-        self.stream = mic.open(format=FORMAT,
-                               channels=self.CHANNELS,
-                               rate=self.RATE,
-                               input=True,
-                               frames_per_buffer=self.CHUNK,
-                               input_device_index=device_id)
-
-        self.freq_buffer = collections.deque(maxlen = input_smooth_window)
+    # comm - connection used for publishing. If None, a new Comm to the configured broker is created
+    # zones - LED chains driven by the analyzer. If None, a single zone with led_count LEDs and filter_bank is used
+    # The visualization shows the first zone. With an empty list, the analyzer only calculates spectra (see analyze)
+    # and does not need a connection
+    def __init__(self, source, viz, publish_mode = "frame", keyframe_interval = 30,
+                 fft_size = 1024, hop_size = 1024, window = "hann",
+                 smoothing = "average", smooth_window = input_smooth_window, attack = 0.5, release = 0.1,
+                 comm = None, led_count = LED_count, filter_bank = None, stats_interval = 10, viz_fps = 20,
+                 zones = None):
+        self.publish_mode = publish_mode
+        if comm is None and zones != []:
+            comm = Comm("SoundAnalyzer")
+            print("Wait for MQTT to connect to broker...")
+            comm.wait_connected()
+        self.comm = comm
+        self.stats = LatencyStats("SoundAnalyzer", stats_interval)
+
+        self.source = source
+        self.RATE = source.rate
+        self.stft = STFT(self.RATE, fft_size, hop_size, window)
+
+        self.smoother = Smoothing.create_smoother(smoothing, len(self.stft.freq), smooth_window, attack, release)
+
+        if zones is None:
+            # Applies all filters to a spectrum at once. Defaults to the filters defined above
+            if filter_bank is None:
+                filter_bank = FilterBank(filters)
+            zones = [Zone("default", led_count, filter_bank, None, publish_mode, keyframe_interval)]
+        check_zone_topics(zones, self.comm.topics, self.comm.codecs)
+        self.zones = zones
 
         # Create visualization window, if activated
         if viz == True:
-            self.viz = Vizualizer(self.RATE)
+            self.viz = Vizualizer(self.RATE, self.stft.freq, zones[0].led_count, viz_fps)
         else:
             self.viz = None
 
 
 if __name__ == "__main__":
     args = parse_args()
-    sa = SoundAnalyzer(args.viz)
+    zones = None
+    if args.zones is not None:
+        zones = load_zones(args.zones, args.publish_mode, args.keyframe_interval)
+    elif args.mapping == "spectrum":
+        zones = [create_spectrum_zone("default", LED_count, args.bands, args.fmin, args.fmax, args.band_scale,
+                                      publish_mode = args.publish_mode, keyframe_interval = args.keyframe_interval)]
+
+    if args.pipeline_workers > 0:
+        if zones is None:
+            zones = [Zone("default", LED_count, FilterBank(filters), None, args.publish_mode, args.keyframe_interval)]
+        # The output processes connect on their own, check the topics before starting them
+        check_zone_topics(zones, *load_topics())
+        if args.viz:
+            print("Visualization is not supported in pipeline mode")
+        results = Pipeline.run_pipeline(functools.partial(create_spectrum_analyzer, args), zones, args.pipeline_workers,
+                                        fft_size = args.fft_size, stats_interval = args.stats_interval)
+        Pipeline.print_results(results)
+        sys.exit(0)
+
+    source = create_audio_source(args)
+    sa = SoundAnalyzer(source, args.viz, args.publish_mode, args.keyframe_interval,
+                       args.fft_size, args.hop_size, args.window,
+                       args.smoothing, args.smooth_window, args.attack, args.release,
+                       stats_interval = args.stats_interval, viz_fps = args.viz_fps, zones = zones)
     if args.remove_mic_noise:
-        try:
-            while True:
-                print("Start collecting microphone noise. There should be no sound playing during this.")
-                print("Stop using Strg + C")
-                sa.calc_mic_noise()
-        except KeyboardInterrupt:
-            print("Stopping collecting mic noise")
-    else:
-        sa.mic_noise_fft = 0
-
-    while True:
-        sa.run()
+        sa.load_mic_noise(args.noise_dir, args.noise_duration, args.recalibrate)
+
+    try:
+        while sa.run():
+            pass
+    except KeyboardInterrupt:
+        pass
+    sa.report_frame_rate()
+    source.close()
+    if sa.viz is not None:
+        sa.viz.close()
@@ -17,7 +17,8 @@ class WebGui:
         comm_dict["id"] = request_form["id"]
         comm_dict["val"] = request_form["req"]
         try:
-            self.comm.publish("power_request", comm_dict)
+            if not self.comm.publish("power_request", comm_dict):
+                print("MQTT is not connected to broker, dropped request " + str(comm_dict))
         except Exception as err:
             print(err)
 
@@ -28,7 +29,8 @@ class WebGui:
         comm_dict["id"] = request_form["id"]
         comm_dict["val"] = request_form["req"]
         try:
-            self.comm.publish("led_request", comm_dict)
+            if not self.comm.publish("led_request", comm_dict):
+                print("MQTT is not connected to broker, dropped request " + str(comm_dict))
         except Exception as err:
             print(err)
 
@@ -38,8 +40,8 @@ class WebGui:
 
     def __init__(self, name):
         self.comm = Comm("WebGUI")
-        while not self.comm.is_connected():
-            pass
+        print("Wait for MQTT to connect to broker...")
+        self.comm.wait_connected()
 
         self.flask_app = Flask(name)
         self.flask_app.register_blueprint(home_page)
@@ -0,0 +1,256 @@
+# A zone is one LED chain driven by the SoundAnalyzer, with its own LED count, filters, colours and output topic
+#
+# The spectrum is calculated once per frame and handed to every zone, which applies its own filter bank,
+# maps the filter responses onto its LEDs and publishes the result. This way a single analyzer can drive
+# several strips, while the FFT is only done once.
+#
+# Zones are configured with one section per zone (see cfg/zones.cfg):
+#   [living_room]
+#   led_count = 100
+#   filters = uniform 50 50
+#             gaussian 1000 300
+#   palette = 0 0 1
+#             1 0 0
+# Each line of filters is a filter type, its center and its width. palette holds one rgb colour per filter.
+# topic is optional and defaults to rgb_frame in frame mode and rgb_values in led mode. A configured topic
+# has to fit the publish mode: frames need a topic with the raw codec, led mode one with the json codec
+# (see check_zone_topics)
+#
+# Zones with mode = spectrum show a spectrum bar instead (see SpectrumZone):
+#   [bar]
+#   mode = spectrum
+#   led_count = 300
+#   bands = 150
+#   fmin = 40
+#   fmax = 12000
+#   scale = mel
+#   palette = 1 0 0
+#             0 0 1
+# bands defaults to one band per LED and scale to log. palette is optional and interpolated across the bands,
+# the default runs through the colour wheel from red to violet
+
+import colorsys
+import configparser
+import numpy as np
+from Filter import UniformFilter, GaussianFilter, FilterBank, SparseFilterBank, create_band_filters
+import LedFrame
+from Communication import JsonCodec, RawCodec
+
+# Filter types, which can be used in the zone config
+FILTER_TYPES = {"uniform": UniformFilter, "gaussian": GaussianFilter}
+
+class Zone:
+    name = ""
+    led_count = 0
+    # Topic id the LED colours are published on
+    topic = None
+    publish_mode = "frame"
+
+    filter_bank = None
+    # Colour of each filter, indexed by filter
+    palette = None
+    # Relative position of each LED in the chain
+    led_positions = None
+
+    frame_encoder = None
+    # Frames lost in the outbound queue, when the last frame has been encoded
+    frame_losses = 0
+
+    # Calculates the response of every filter to the spectrum, normed to a sum of one
+    def get_color_vector(self, amplitudes, freq):
+        colorVector = self.filter_bank.get_filtered_result(amplitudes, freq)
+        # Resize color vector to unit size -> Sum should be one, in order to match LED colors
+        colorVectorLength = sum(colorVector)
+        return colorVector / colorVectorLength
+
+    # Maps the normed filter responses onto the LED chain. Each filter gets a contiguous
+    # segment of LEDs, whose length is proportional to its response.
+    # Returns an (LED count, 3) array containing the rgb value of each LED
+    def colorVectorToRgbValues(self, colorVector):
+        # Check if colorVector is unitsized, which is needed to match it to the LED chain
+        # Deal with floating point errors by checking against threshold
+        colorVectorSum = np.cumsum(colorVector)
+        if abs(colorVectorSum[-1] - 1.0) > 0.00001:
+            raise ValueError("Sum of filter responses needs to be == 1: " + str(colorVector) + " -> " + str(colorVectorSum[-1]))
+
+        # Search for Color range each LED belongs to
+        segment = np.searchsorted(colorVectorSum, self.led_positions, side='left')
+        if segment[-1] >= len(self.palette):
+            i = int(np.argmax(segment >= len(self.palette)))
+            raise ValueError("For LED " + str(self.led_positions[i]) + " no filter response " + str(colorVector))
+
+        return self.palette[segment]
+
+    # Publishes the rgb values of the LED chain. In frame mode the whole chain is sent as one
+    # binary message, containing either the full frame or only the changed LEDs (see LedFrame).
+    # Otherwise every LED is sent as its own json message
+    # capture_time - time at which the audio of this frame was recorded, sent along in frame mode
+    def publish_rgb(self, comm, rgb_values, capture_time = 0.0):
+        if self.publish_mode == "frame":
+            # Delta frames depend on all previous ones. If the outbound queue has dropped a frame,
+            # resynchronize the receiver with a keyframe
+            losses = comm.get_outbound_losses(self.topic)
+            if losses != self.frame_losses:
+                self.frame_losses = losses
+                self.frame_encoder.request_keyframe()
+            comm.publish(self.topic, self.frame_encoder.encode(rgb_values, capture_time))
+        else:
+            # Frames of the pipeline mode are already converted to uint8, but json messages carry [0, 1]
+            if rgb_values.dtype == np.uint8:
+                rgb_values = rgb_values / 255
+            for i,rgb in enumerate(rgb_values.tolist()):
+                comm.publish(self.topic, {"id": i, "rgb": rgb})
+
+    # name - name of the zone, e.g. the section in the zone config
+    # filter_bank - filters applied to the spectrum. Their colours are used as palette
+    # topic - topic id to publish on. Defaults to rgb_frame in frame mode and rgb_values in led mode
+    def __init__(self, name, led_count, filter_bank, topic = None, publish_mode = "frame", keyframe_interval = 30):
+        if led_count < 1:
+            raise ValueError("Zone " + str(name) + " needs at least one LED")
+        if publish_mode not in PUBLISH_MODE_CODECS:
+            raise ValueError("Unknown publish mode " + str(publish_mode) + " of zone " + str(name))
+        if topic is None:
+            topic = "rgb_frame" if publish_mode == "frame" else "rgb_values"
+        self.name = name
+        self.led_count = led_count
+        self.topic = topic
+        self.publish_mode = publish_mode
+        self.filter_bank = filter_bank
+        self.palette = filter_bank.get_colours()
+        self.led_positions = np.arange(led_count, dtype=np.float64) / led_count
+        self.frame_encoder = LedFrame.FrameEncoder(keyframe_interval)
+        self.frame_losses = 0
+
+# Shows the spectrum as bar along the LED chain. Every LED (or group of neighbouring LEDs) belongs to one
+# narrow frequency band, lower bands at the start of the chain. Its brightness is the level of the band
+# relative to the loudest band of the frame, its colour the colour of the band
+class SpectrumZone(Zone):
+    # Band shown by each LED
+    led_bands = None
+    # Colour of the band of each LED
+    led_palette = None
+    rgb_values = None
+
+    # Calculates the level of every band relative to the loudest one
+    def get_color_vector(self, amplitudes, freq):
+        levels = self.filter_bank.get_filtered_result(amplitudes, freq)
+        peak = np.max(levels)
+        if peak > 0:
+            levels = levels / peak
+        return levels
+
+    # Scales the colour of every LED by the level of its band
+    # Returns an (LED count, 3) array, which is overwritten by the next call
+    def colorVectorToRgbValues(self, colorVector):
+        np.multiply(self.led_palette, colorVector[self.led_bands, np.newaxis], out=self.rgb_values)
+        return self.rgb_values
+
+    # filter_bank - one filter per band, ordered by frequency. Their colours are used as palette
+    def __init__(self, name, led_count, filter_bank, topic = None, publish_mode = "frame", keyframe_interval = 30):
+        super().__init__(name, led_count, filter_bank, topic, publish_mode, keyframe_interval)
+        band_count = len(filter_bank.filters)
+        self.led_bands = np.arange(led_count) * band_count // led_count
+        self.led_palette = self.palette[self.led_bands]
+        self.rgb_values = np.zeros((led_count, 3), dtype=np.float32)
+
+# Interpolates the colours of a palette evenly across band_count bands
+def interpolate_palette(palette, band_count):
+    palette = np.asarray(palette, dtype=np.float64)
+    if len(palette) == 1:
+        return np.repeat(palette, band_count, axis=0)
+    positions = np.linspace(0, len(palette) - 1, band_count)
+    return np.stack([np.interp(positions, np.arange(len(palette)), palette[:, c]) for c in range(3)], axis=1)
+
+# Colour wheel from red to violet, the default palette of spectrum zones
+DEFAULT_SPECTRUM_PALETTE = [colorsys.hsv_to_rgb(0.8 * i / 7, 1, 1) for i in range(8)]
+
+# Creates a spectrum zone with band_count bands between fmin and fmax on a log or mel scale
+# band_count - defaults to one band per LED
+def create_spectrum_zone(name, led_count, band_count = None, fmin = 40, fmax = 12000, scale = "log",
+                         palette = DEFAULT_SPECTRUM_PALETTE, topic = None, publish_mode = "frame", keyframe_interval = 30):
+    if band_count is None:
+        band_count = led_count
+    filters = create_band_filters(band_count, fmin, fmax, scale, interpolate_palette(palette, band_count))
+    return SpectrumZone(name, led_count, SparseFilterBank(filters), topic, publish_mode, keyframe_interval)
+
+# Creates a spectrum zone from its config section
+def load_spectrum_zone(section, publish_mode, keyframe_interval):
+    name = section.name
+    palette = DEFAULT_SPECTRUM_PALETTE
+    if "palette" in section:
+        palette_rows = parse_rows(section["palette"])
+        if not palette_rows or any(len(colour) != 3 for colour in palette_rows):
+            raise Exception("Invalid palette in zone " + str(name) + ". Expected one <r> <g> <b> colour per line")
+        palette = [[float(c) for c in colour] for colour in palette_rows]
+
+    band_count = section.getint("bands") if "bands" in section else None
+    return create_spectrum_zone(name, section.getint("led_count"), band_count, section.getfloat("fmin", 40),
+                                section.getfloat("fmax", 12000), section.get("scale", "log"), palette,
+                                section.get("topic"), publish_mode, keyframe_interval)
+
+# Parses a multi-line config value into one list of numbers per line
+def parse_rows(value):
+    return [line.split() for line in value.splitlines() if line.strip()]
+
+# Creates the filter bank of a zone section
+def create_filter_bank(section):
+    name = section.name
+    if "filters" not in section or "palette" not in section:
+        raise Exception("Zone " + str(name) + " needs filters and a palette")
+
+    filter_rows = parse_rows(section["filters"])
+    palette_rows = parse_rows(section["palette"])
+    if len(filter_rows) != len(palette_rows):
+        raise Exception("Zone " + str(name) + " needs one palette colour per filter: " +
+                        str(len(filter_rows)) + " filters, " + str(len(palette_rows)) + " colours")
+
+    filters = []
+    for row, colour in zip(filter_rows, palette_rows):
+        if len(row) != 3 or row[0] not in FILTER_TYPES:
+            raise Exception("Invalid filter " + " ".join(row) + " in zone " + str(name) +
+                            ". Expected <" + "|".join(FILTER_TYPES) + "> <center> <width>")
+        if len(colour) != 3:
+            raise Exception("Invalid colour " + " ".join(colour) + " in zone " + str(name) + ". Expected <r> <g> <b>")
+        filters.append(FILTER_TYPES[row[0]](center = float(row[1]), width = float(row[2]),
+                                            colour = tuple(float(c) for c in colour)))
+    return FilterBank(filters)
+
+# Codec each publish mode needs for the topic of a zone: binary frames are sent raw, single LEDs as json dicts
+PUBLISH_MODE_CODECS = {"frame": RawCodec, "led": JsonCodec}
+
+# Checks that the topic of every zone is configured and its codec can carry the messages of the publish mode,
+# so a mismatch fails at startup instead of with the first frame
+# topics, codecs - topics and codecs by topic id of the communication config (see Communication.read_topics)
+def check_zone_topics(zones, topics, codecs):
+    for zone in zones:
+        if zone.topic not in topics:
+            raise Exception("Topic " + str(zone.topic) + " of zone " + str(zone.name) + " can not be found under [Topics] in the provided config file")
+        codec = codecs.get(zone.topic, JsonCodec())
+        expected = PUBLISH_MODE_CODECS[zone.publish_mode]
+        if not isinstance(codec, expected):
+            raise Exception("Topic " + str(zone.topic) + " of zone " + str(zone.name) + " uses the " + type(codec).__name__ +
+                            ", but publish mode " + zone.publish_mode + " needs the " + expected.__name__ +
+                            ". Choose another topic for the zone or configure its codec under [Codecs]")
+
+# Reads all zones of a zone config file
+def load_zones(configfile, publish_mode = "frame", keyframe_interval = 30):
+    config = configparser.ConfigParser()
+    if not config.read(configfile):
+        raise Exception("Zone config " + str(configfile) + " can not be read")
+    if not config.sections():
+        raise Exception("Zone config " + str(configfile) + " needs at least one zone section")
+
+    zones = []
+    for name in config.sections():
+        section = config[name]
+        if "led_count" not in section:
+            raise Exception("Zone " + str(name) + " needs a led_count")
+        mode = section.get("mode", "segments")
+        if mode == "spectrum":
+            zones.append(load_spectrum_zone(section, publish_mode, keyframe_interval))
+            continue
+        elif mode != "segments":
+            raise Exception("Unknown mode " + str(mode) + " of zone " + str(name) + ". Known modes are segments and spectrum")
+        zones.append(Zone(name, section.getint("led_count"), create_filter_bank(section),
+                          section.get("topic"), publish_mode, keyframe_interval))
+    return zones
@@ -5,9 +5,17 @@
 # Taken from https://github.com/rpi-ws281x/rpi-ws281x-python/tree/master/examples
 
 import time
-from rpi_ws281x import PixelStrip, Color
+import math
+import threading
 import argparse
+import numpy as np
 from Communication import Comm
+import LedFrame
+from LatencyStats import LatencyStats
+import MockStrip
+from PixelPipeline import PixelPipeline
+import Animation
+from JitterBuffer import JitterBuffer
 
 # LED strip configuration:
 LED_PIN = 18          # GPIO pin connected to the pixels (18 uses PWM!).
@@ -18,33 +26,271 @@ LED_INVERT = False    # True to invert the signal (when using NPN transistor lev
 LED_CHANNEL = 0       # set to '1' for GPIOs 13, 19, 41, 45 or 53
 
 strip = None
+renderer = None
 
 power = "off"
 mode = "color"
-rgb_values = []
+# Parameters of the local effects, can be changed by led_request commands
+effect_params = {"color": [255, 255, 255], "speed": 0.2, "spread": 1, "period": 4, "duration": 1}
+# Seconds a power on/off wipe takes per LED
+wipe_time_per_led = 0.01
+# Receive buffer, holding one uint8 rgb value per LED. Handed to the renderer once a frame is complete
+rgb_values = None
+# Decodes received binary frames into the receive buffer
+frame_decoder = None
 
+# Latencies of received frames, published periodically on the stats topic
+stats = LatencyStats("LedControl")
 
-# Define functions which animate LEDs in various ways.
-def colorWipe(strip, color, wait_ms=50):
-    """Wipe color across display a pixel at a time."""
-    for i in range(strip.numPixels()):
-        strip.setPixelColor(i, color)
-        strip.show()
-        time.sleep(wait_ms/1000.0)
+# Shows frames on the strip from its own thread
+# Frames are double buffered: receivers copy complete frames into the pending buffer with submit,
+# the renderer swaps it with the front buffer and shows it. show() is only called if a new frame
+# has been submitted or an effect is running, and at most once every min_interval seconds
+# Effects (see Animation.py) are rendered directly into the front buffer on the clock of the renderer.
+# A submitted frame stops all running effects
+# If a jitter buffer is set, received frames are buffered and interpolated on the clock of the renderer instead
+class Renderer:
+    strip = None
+    pipeline = None
+    front = None
+    pending = None
+    # Capture and receive time of the pending frame
+    pending_times = None
+    dirty = False
+    lock = None
+    new_frame = None
+    thread = None
+    running = False
 
+    # Effects to run one after another, the first one is the current one
+    animations = []
+    animation_start = None
+    animation_done = None
 
+    # Interpolates between received frames, None to show them as they arrive
+    jitter_buffer = None
+
+    min_interval = 0
+    # Achieved frames per second, updated every second
+    fps = 0
+    shown_frames = 0
+
+    # Hands a complete (LED count, 3) uint8 frame over to the renderer. Replaces any frame, which has not been shown yet
+    def submit(self, frame, capture_time = None, receive_time = None):
+        with self.lock:
+            if self.jitter_buffer is not None and receive_time is not None:
+                self.animations = []
+                self.animation_done.set()
+                if not self.jitter_buffer.push(frame, capture_time, receive_time):
+                    stats.count("late_frames")
+                self.new_frame.set()
+                return
+            np.copyto(self.pending, frame)
+            self.pending_times = (capture_time, receive_time)
+            self.dirty = True
+        self.new_frame.set()
+
+    # Writes a frame to the strip
+    def show(self, frame):
+        self.pipeline.write(self.strip, frame)
+
+    # Replaces any running effects with the given ones, which are run one after another
+    def set_animation(self, *effects):
+        with self.lock:
+            self.animations = list(effects)
+            self.animation_start = None
+            if self.animations:
+                self.animation_done.clear()
+            else:
+                self.animation_done.set()
+        self.new_frame.set()
+
+    # Blocks until all effects have finished. Returns False, if timeout has been reached before
+    def wait_animation(self, timeout = None):
+        return self.animation_done.wait(timeout)
+
+    # Renders the next frame of the current effect and shows it. Returns False, if no effect is running
+    def show_animation(self):
+        with self.lock:
+            if not self.animations:
+                return False
+            effect = self.animations[0]
+            now = time.time()
+            try:
+                if self.animation_start is None:
+                    effect.start(self.front)
+                    self.animation_start = now
+                t = now - self.animation_start
+                effect.render(t, self.front)
+                finished = effect.finished(t)
+            except Exception as err:
+                # Skip a broken effect instead of failing on it every frame
+                print("Stopped effect " + type(effect).__name__ + ": " + repr(err))
+                stats.count("effect_errors")
+                finished = True
+            if finished:
+                self.animations.pop(0)
+                self.animation_start = None
+                if not self.animations:
+                    self.animation_done.set()
+
+        self.show(self.front)
+        self.shown_frames += 1
+        return True
+
+    # Renders the interpolated frame at the current time and shows it. Returns False, if there is nothing new to show
+    def show_interpolated(self):
+        if self.jitter_buffer is None:
+            return False
+        with self.lock:
+            now = time.time()
+            if not self.jitter_buffer.render(now, self.front):
+                return False
+            play_time = self.jitter_buffer.play_time(now)
+
+        self.show(self.front)
+        self.shown_frames += 1
+        stats.record("show", time.time() - play_time)
+        return True
+
+    # Shows the pending frame, if there is one. Returns False otherwise
+    def show_pending(self):
+        with self.lock:
+            self.new_frame.clear()
+            if not self.dirty:
+                return False
+            self.front, self.pending = self.pending, self.front
+            (capture_time, receive_time) = self.pending_times
+            self.dirty = False
+            self.animations = []
+            self.animation_done.set()
+
+        self.show(self.front)
+        self.shown_frames += 1
+
+        # Record latency of received frames from capture and receive until they are shown
+        if receive_time is not None:
+            show_time = time.time()
+            stats.record("show", show_time - capture_time)
+            stats.record("render", show_time - receive_time)
+        return True
+
+    def run(self):
+        last_show = 0
+        fps_start = time.time()
+        fps_frames = 0
+        while self.running:
+            # Effects and interpolated frames are rendered every tick, otherwise wait for new frames
+            interpolating = self.jitter_buffer is not None and self.jitter_buffer.active(time.time())
+            if not self.animations and not interpolating:
+                self.new_frame.wait(timeout = 1)
+                self.new_frame.clear()
+
+            # Cap the frame rate
+            wait = last_show + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            # A frame failing to render or show must not stop the render thread
+            try:
+                shown = self.show_pending() or self.show_interpolated() or self.show_animation()
+            except Exception as err:
+                print("Failed to show frame: " + repr(err))
+                stats.count("render_errors")
+                shown = False
+            if shown:
+                last_show = time.time()
+                fps_frames += 1
+            elif interpolating:
+                # Holding a frame until playback reaches the next one
+                time.sleep(max(self.min_interval, 0.001))
+
+            now = time.time()
+            if now - fps_start >= 1:
+                self.fps = fps_frames / (now - fps_start)
+                stats.gauge("fps", self.fps)
+                fps_start = now
+                fps_frames = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stops the render thread, after showing any pending frame
+    def stop(self):
+        self.running = False
+        self.new_frame.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.show_pending()
+
+    # min_interval - minimum time in seconds between two calls to strip.show()
+    # pipeline - converts frames to the words written to the strip, applying gamma, brightness and white balance
+    # jitter_delay - seconds by which received frames are delayed to interpolate between them, None to show them immediately
+    def __init__(self, strip, led_count, min_interval = 0.01, pipeline = None, jitter_delay = None):
+        self.strip = strip
+        self.pipeline = pipeline if pipeline is not None else PixelPipeline()
+        self.front = np.zeros((led_count, 3), dtype=np.uint8)
+        self.pending = np.zeros((led_count, 3), dtype=np.uint8)
+        self.pending_times = (None, None)
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.new_frame = threading.Event()
+        self.animations = []
+        self.animation_start = None
+        self.animation_done = threading.Event()
+        self.animation_done.set()
+        self.jitter_buffer = None if jitter_delay is None else JitterBuffer(led_count, jitter_delay)
+        self.min_interval = min_interval
+        self.fps = 0
+        self.shown_frames = 0
+
+# Returns the effects shown in the given mode. In sound mode, frames are received instead
+def mode_effects(mode):
+    if mode == "color":
+        # Without a duration the colour is set at once, instead of fading to it
+        if effect_params["duration"] == 0:
+            return [Animation.StaticColour(effect_params["color"])]
+        return [Animation.Fade(effect_params["color"], effect_params["duration"])]
+    elif mode == "rainbow" or mode == "wave":
+        return [Animation.Rainbow(effect_params["speed"], effect_params["spread"])]
+    elif mode == "breathing":
+        return [Animation.Breathing(effect_params["color"], effect_params["period"])]
+    elif mode == "wipe":
+        return [Animation.Wipe(effect_params["color"], effect_params["duration"])]
+    return []
+
+# Wipe colour across the whole strip
+def colorWipe(renderer, rgb):
+    return Animation.Wipe(rgb, len(renderer.front) * wipe_time_per_led)
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--leds', type=int, default=100,
                         help='Numbers of LEDs in chain')
-    parser.add_argument('--freq', type=int, default=10, help='Time in ms between each LED update')
+    parser.add_argument('--freq', type=int, default=10, help='Minimum time in ms between each LED update')
+    parser.add_argument('--mock', action='store_true',
+                        help='Use an in-memory stand-in instead of the LED strip, e.g. to run without a Raspberry Pi')
+    parser.add_argument('--interpolate', action='store_true',
+                        help='Crossfade between received frames at the local render rate')
+    parser.add_argument('--jitter_delay', type=int, default=60,
+                        help='Time in ms received frames are buffered when interpolating, to smooth irregular arrival')
+    parser.add_argument('--gamma', type=float, default=2.2,
+                        help='Gamma correction applied to all colours, 1 to disable it')
+    parser.add_argument('--brightness', type=float, default=1.0,
+                        help='Brightness factor applied to all colours, in [0, 1]')
+    parser.add_argument('--white_balance', type=float, nargs=3, default=[1.0, 1.0, 1.0],
+                        help='Factors applied to the red, green and blue channel')
+    parser.add_argument('--stats_interval', type=float, default=10,
+                        help='Seconds between publishing latency statistics on the stats topic')
+    parser.add_argument('--frame_topic', default='rgb_frame',
+                        help='Topic id the LED frames of this strip are received on, e.g. the topic of its zone in cfg/zones.cfg')
     return parser.parse_args()
 
 def set_led_color(led_color_command):
     global rgb_values
 
-    print(led_color_command)
     # Parse LED Id and required rgb values from recieved command
     if "id" not in led_color_command:
         print("LED \"id\" not found in led_color_command: " + str(led_color_command))
@@ -59,62 +305,169 @@ def set_led_color(led_color_command):
     if "rgb" not in led_color_command or len(led_color_command["rgb"]) != 3:
         print("No valid LED \"rgb\" found in led_color_command: " + str(led_color_command))
         return
-    else:
-        [r, g, b] = led_color_command["rgb"]
-        [r, g, b] = [r * 255, g *255, b * 255]
 
-    rgb_values[led_id] = [r,g,b]
+    # Scale rgb values from [0, 1] to uint8
+    rgb_values[led_id] = LedFrame.rgb_to_bytes(led_color_command["rgb"])
+
+    # LEDs are sent in order, so the frame is complete with the last LED
+    if led_id == len(rgb_values) - 1 and power == "on" and mode == "sound":
+        renderer.submit(rgb_values)
+
+# Callback of binary frames containing the whole LED chain or the changes to the previous frame (see LedFrame)
+# Frame is decoded directly into the frame buffer
+def set_led_frame(payload):
+    global frame_decoder
+
+    receive_time = time.time()
+    dropped = frame_decoder.dropped
+    try:
+        updated = frame_decoder.decode(payload)
+    except ValueError as err:
+        print("Received invalid LED frame: " + str(err))
+        stats.count("invalid_frames")
+        return
+
+    stats.count("frames")
+    if frame_decoder.dropped != dropped:
+        stats.count("dropped_frames", frame_decoder.dropped - dropped)
+    if updated:
+        stats.record("receive", receive_time - frame_decoder.capture_time)
+        if power == "on" and mode == "sound":
+            renderer.submit(rgb_values, frame_decoder.capture_time, receive_time)
+
+# Converts a colour of a led_request command to a list of three ints in [0, 255]
+# Raises ValueError, if it is no such colour
+def parse_color(value):
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        raise ValueError("expected [r, g, b]")
+    color = [parse_number(c) for c in value]
+    if any(c < 0 or c > 255 for c in color):
+        raise ValueError("expected values in [0, 255]")
+    return [int(round(c)) for c in color]
+
+# Converts a number of a led_request command to a finite float. Raises ValueError otherwise
+def parse_number(value):
+    if isinstance(value, bool):
+        raise ValueError("expected a number")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("expected a number")
+    if not math.isfinite(number):
+        raise ValueError("expected a finite number")
+    return number
+
+# Converts a number, which has to be > 0, e.g. a period an effect is divided by
+def parse_positive(value):
+    number = parse_number(value)
+    if number <= 0:
+        raise ValueError("expected a number > 0")
+    return number
 
-def update_rgb_values():
-    global rgb_values,strip,power,mode
+# Converts a number, which has to be >= 0, e.g. a duration
+def parse_non_negative(value):
+    number = parse_number(value)
+    if number < 0:
+        raise ValueError("expected a number >= 0")
+    return number
 
-    if power == "on" and mode == "sound":
-        for i,[r,g,b] in enumerate(rgb_values):
-            strip.setPixelColor(i,Color(r,g,b))
-        strip.show()
+# Converts each effect parameter of a led_request command, so invalid values are rejected before they reach an effect
+EFFECT_PARAM_PARSERS = {"color": parse_color, "speed": parse_number, "spread": parse_positive,
+                        "period": parse_positive, "duration": parse_non_negative}
+
+# Returns the converted effect parameters of a led_request command
+# Raises ValueError naming the first invalid parameter
+def parse_effect_params(led_control_command):
+    params = {}
+    for param, parse in EFFECT_PARAM_PARSERS.items():
+        if param in led_control_command:
+            try:
+                params[param] = parse(led_control_command[param])
+            except ValueError as err:
+                raise ValueError("Invalid " + param + " " + repr(led_control_command[param]) + ": " + str(err))
+    return params
 
 # Callback of led_control commands. Expects a dict of the form:
 # {"id": id, "val": val}
-# where id denotes the setting and val the required value of that setting
+# where id denotes the setting and val the required value of that setting.
+# Effect parameters (color, speed, spread, period, duration) can be passed along as additional fields
+# Only starts the effects, which are then run by the renderer. Returns immediately
 def led_control(led_control_command):
     global power, mode
+
+    if "id" not in led_control_command or "val" not in led_control_command:
+        print("Missing \"id\" or \"val\" in led_control_command: " + str(led_control_command))
+        return
+
+    # Commands with an invalid parameter are rejected as a whole
+    try:
+        params = parse_effect_params(led_control_command)
+        if led_control_command["id"] == "led_color":
+            params.update(parse_effect_params({"color": led_control_command["val"]}))
+    except ValueError as err:
+        print("Rejected led_control_command: " + str(err))
+        return
+    effect_params.update(params)
+
     # Disabled/Enable LED strip, switch mode
     if led_control_command["id"] == "led_power":
         if led_control_command["val"] == "on":
             power = "on"
-            colorWipe(strip, Color(255,255,255), 10)
+            renderer.set_animation(colorWipe(renderer, (255,255,255)), *mode_effects(mode))
         if led_control_command["val"] == "off":
             power = "off"
-            colorWipe(strip, Color(0,0,0), 10)
+            renderer.set_animation(colorWipe(renderer, (0,0,0)))
     elif led_control_command["id"] == "led_mode":
-        mode = led_control_commend["val"]
+        if led_control_command["val"] not in ["sound", "color", "rainbow", "wave", "breathing", "wipe"]:
+            print("Unknown led mode: " + str(led_control_command["val"]))
+            return
+        mode = led_control_command["val"]
+        if power == "on":
+            renderer.set_animation(*mode_effects(mode))
+    elif led_control_command["id"] == "led_color":
+        if power == "on":
+            renderer.set_animation(*mode_effects(mode))
 
 # Main program logic follows:
 if __name__ == '__main__':
     args = parse_args()
 
     # Create NeoPixel object with appropriate configuration.
-    strip = PixelStrip(int(args.leds), LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
+    # rpi_ws281x is only imported here, so the module can be used without it, e.g. by the benchmark.
+    # Without --mock a missing or broken install fails loudly instead of lighting nothing
+    if args.mock:
+        StripType = MockStrip.PixelStrip
+    else:
+        from rpi_ws281x import PixelStrip as StripType
+    strip = StripType(int(args.leds), LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
     # Intialize the library (must be called once before other functions).
     strip.begin()
 
-    for i in range(int(args.leds)):
-        rgb_values.append([255,255,255])
-    
+    rgb_values = np.full((int(args.leds), 3), 255, dtype=np.uint8)
+    frame_decoder = LedFrame.FrameDecoder(rgb_values)
+    stats.interval = args.stats_interval
+
+    pipeline = PixelPipeline(args.gamma, args.brightness, args.white_balance)
+    jitter_delay = args.jitter_delay/1000 if args.interpolate else None
+    renderer = Renderer(strip, int(args.leds), int(args.freq)/1000, pipeline, jitter_delay)
+    renderer.start()
+
     comm = Comm("LedControl")
     print("Wait for MQTT to connect to broker...")
-    while not comm.is_connected():
-        pass
+    comm.wait_connected()
     print("connected")
     comm.subscribe("rgb_values", set_led_color)
+    comm.subscribe(args.frame_topic, set_led_frame)
     comm.subscribe("led_request", led_control)
 
     print('Press Ctrl-C to quit.')
     try:
         while True:
-            time.sleep(int(args.freq)/1000)
-            update_rgb_values()
-            pass
+            time.sleep(1)
+            stats.publish_if_due(comm, "stats")
     except KeyboardInterrupt:
-        colorWipe(strip, Color(0, 0, 0), 10)
+        renderer.set_animation(colorWipe(renderer, (0, 0, 0)))
+        renderer.wait_animation(timeout = 10)
+        renderer.stop()
+        print("Shown {} frames, {:.1f} fps".format(renderer.shown_frames, renderer.fps))
 
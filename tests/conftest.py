@@ -0,0 +1,50 @@
+# The nodes are plain modules in the repository root, make them importable from the tests
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import Communication
+
+BROKER_CONFIG = "[Broker]\nip = localhost\nport = 1883\nusername = user\npassword = pw\n"
+
+# Stand-in for the paho client. Records subscriptions and published payloads without sending anything
+# Every request gets the next mid. rc is returned as result of all requests, e.g. to simulate a lost connection
+class FakeClient:
+    class MessageInfo:
+        def __init__(self, rc, mid):
+            self.rc = rc
+            self.mid = mid
+
+    def __init__(self, *args, **kwargs):
+        self.subscribed = []
+        self.published = []
+        self.mid = 0
+        self.rc = Communication.mqtt_client.MQTT_ERR_SUCCESS
+
+    # Connecting, the network loop and all other calls are no-ops
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+        self.mid += 1
+        return (self.rc, self.mid)
+
+    def publish(self, topic, payload, retain = False):
+        self.published.append(payload)
+        self.mid += 1
+        return FakeClient.MessageInfo(self.rc, self.mid)
+
+# Creates a Comm on a FakeClient from the given config sections, e.g. "[Topics]\nframe = /frame\n"
+# The broker section is added. The client does not connect until the test calls on_connect
+@pytest.fixture
+def create_comm(tmp_path, monkeypatch):
+    monkeypatch.setattr(Communication.mqtt_client, "Client", FakeClient)
+
+    def create(sections):
+        config = tmp_path / "comm.cfg"
+        config.write_text(BROKER_CONFIG + sections)
+        return Communication.Comm("test", str(config))
+    return create
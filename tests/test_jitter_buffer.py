@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from JitterBuffer import JitterBuffer
+
+LED_COUNT = 2
+# Receive time minus capture time of every frame, unless a test delays a frame
+OFFSET = 90.0
+DELAY = 0.1
+
+def frame(value):
+    return np.full((LED_COUNT, 3), value, dtype=np.uint8)
+
+# Pushes a frame, which arrives offset seconds after its capture
+def push(buffer, value, capture_time, offset = OFFSET):
+    return buffer.push(frame(value), capture_time, capture_time + offset)
+
+# Time at which the given capture time is played back
+def at(capture_time):
+    return capture_time + OFFSET + DELAY
+
+@pytest.fixture
+def buffer():
+    buffer = JitterBuffer(LED_COUNT, delay = DELAY, capacity = 4)
+    push(buffer, 0, 10.0)
+    push(buffer, 200, 10.1)
+    return buffer
+
+def test_crossfades_halfway_between_frames(buffer):
+    out = frame(0)
+    assert buffer.active(at(10.05))
+    assert buffer.render(at(10.05), out)
+    assert out.tolist() == frame(100).tolist()
+    assert buffer.render(at(10.075), out)
+    assert out.tolist() == frame(150).tolist()
+
+def test_late_and_duplicate_frames_are_dropped(buffer):
+    assert not push(buffer, 50, 10.1)
+    assert not push(buffer, 50, 10.05)
+    assert buffer.count == 2
+    assert push(buffer, 50, 10.2)
+    assert buffer.count == 3
+
+def test_holds_oldest_frame_before_playback_reaches_it(buffer):
+    out = frame(99)
+    assert buffer.render(at(9.9), out)
+    assert out.tolist() == frame(0).tolist()
+    # Same frame again, nothing new to render
+    assert not buffer.render(at(9.95), out)
+
+def test_holds_newest_frame_without_rendering_it_again(buffer):
+    out = frame(0)
+    assert buffer.render(at(10.2), out)
+    assert out.tolist() == frame(200).tolist()
+    assert not buffer.active(at(10.3))
+    out[:] = 7
+    assert not buffer.render(at(10.3), out)
+    assert out.tolist() == frame(7).tolist()
+
+    # A new frame is rendered again
+    push(buffer, 100, 10.5)
+    assert buffer.active(at(10.3))
+    assert buffer.render(at(10.3), out)
+
+def test_single_slow_frame_does_not_shift_offset(buffer):
+    assert buffer.offset == pytest.approx(OFFSET)
+    push(buffer, 0, 10.2, offset = OFFSET + 0.5)
+    assert buffer.offset == pytest.approx(OFFSET + buffer.offset_adapt * 0.5)
+    assert buffer.play_time(at(10.15)) == pytest.approx(10.15, abs = 0.01)
+
+def test_faster_transmission_is_followed_immediately(buffer):
+    push(buffer, 0, 10.2, offset = OFFSET - 0.05)
+    assert buffer.offset == pytest.approx(OFFSET - 0.05)
+
+def test_frames_before_playback_are_trimmed(buffer):
+    push(buffer, 100, 10.2)
+    push(buffer, 50, 10.3)
+    out = frame(0)
+    assert buffer.render(at(10.25), out)
+    # Frames at 10.0 and 10.1 are not needed anymore
+    assert buffer.count == 2
+    assert out.tolist() == frame(75).tolist()
+
+def test_capacity_keeps_newest_frames(buffer):
+    for i in range(2, 6):
+        push(buffer, i, 10.0 + i / 10)
+    assert buffer.count == 4
+    out = frame(0)
+    assert buffer.render(at(10.0), out)
+    assert out.tolist() == frame(2).tolist()
+
+def test_empty_buffer_renders_nothing():
+    buffer = JitterBuffer(LED_COUNT)
+    assert not buffer.active(0)
+    assert not buffer.render(0, frame(0))
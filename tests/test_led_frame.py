@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import LedFrame
+
+LED_COUNT = 20
+
+def frame(value):
+    return np.full((LED_COUNT, 3), value, dtype=np.uint8)
+
+def create_decoder():
+    return LedFrame.FrameDecoder(np.zeros((LED_COUNT, 3), dtype=np.uint8))
+
+def test_full_frame_round_trip():
+    rgb = np.random.RandomState(0).randint(0, 256, (LED_COUNT, 3)).astype(np.uint8)
+    seq, decoded = LedFrame.decode_frame(LedFrame.encode_frame(rgb, 7, 1.5))
+    assert seq == 7
+    assert np.array_equal(decoded, rgb)
+
+def test_float_values_are_scaled_to_bytes():
+    assert LedFrame.rgb_to_bytes([[0.0, 0.5, 1.0], [-1.0, 2.0, 1 / 255]]).tolist() == [[0, 128, 255], [0, 255, 1]]
+
+def test_deltas_reproduce_every_frame():
+    encoder = LedFrame.FrameEncoder(keyframe_interval = 10)
+    decoder = create_decoder()
+    rgb = frame(0)
+    for i in range(25):
+        rgb[i % LED_COUNT] = i * 10
+        payload = encoder.encode(rgb, capture_time = i)
+        assert decoder.decode(payload)
+        assert np.array_equal(decoder.frame_buffer, rgb)
+        assert decoder.capture_time == i
+    assert decoder.dropped == 0
+
+def test_unchanged_frame_is_sent_as_empty_delta():
+    encoder = LedFrame.FrameEncoder()
+    encoder.encode(frame(1))
+    payload = encoder.encode(frame(1))
+    assert LedFrame.decode_header(payload)[0] == LedFrame.FRAME_DELTA
+    assert len(payload) == LedFrame.FRAME_HEADER.size
+
+def test_lost_frame_waits_for_keyframe():
+    encoder = LedFrame.FrameEncoder(keyframe_interval = 5)
+    decoder = create_decoder()
+    payloads = []
+    for i in range(6):
+        rgb = frame(0)
+        rgb[i] = 255
+        payloads.append(encoder.encode(rgb))
+
+    decoder.decode(payloads[0])
+    # Frame 1 is lost, the deltas 2 to 4 can not be applied
+    for payload in payloads[2:5]:
+        assert not decoder.decode(payload)
+    assert decoder.dropped == 1
+    assert not decoder.synced
+
+    # Frame 5 is a keyframe
+    assert decoder.decode(payloads[5])
+    assert decoder.synced
+    assert decoder.frame_buffer[5].tolist() == [255, 255, 255]
+
+def test_duplicate_frame_is_not_counted_as_dropped():
+    encoder = LedFrame.FrameEncoder()
+    decoder = create_decoder()
+    first = encoder.encode(frame(1))
+    decoder.decode(first)
+    decoder.decode(first)
+    assert decoder.dropped == 0
+
+def test_sender_restart_resyncs_without_drops():
+    decoder = create_decoder()
+    encoder = LedFrame.FrameEncoder()
+    for i in range(5):
+        decoder.decode(encoder.encode(frame(i)))
+
+    restarted = LedFrame.FrameEncoder()
+    assert decoder.decode(restarted.encode(frame(42)))
+    assert decoder.dropped == 0
+    assert decoder.seq == 0
+    assert np.array_equal(decoder.frame_buffer, frame(42))
+
+def test_sequence_wrap_is_consecutive():
+    decoder = create_decoder()
+    decoder.decode(LedFrame.encode_frame(frame(1), LedFrame.SEQ_MODULO - 1))
+    decoder.decode(LedFrame.encode_frame(frame(2), 0))
+    decoder.decode(LedFrame.encode_frame(frame(3), 3))
+    assert decoder.dropped == 2
+
+@pytest.mark.parametrize("payload", [b"\x01\x00", LedFrame.FRAME_HEADER.pack(9, 0, 0.0, 0)])
+def test_invalid_messages_raise(payload):
+    with pytest.raises(ValueError):
+        create_decoder().decode(payload)
+
+def test_truncated_delta_is_rejected_and_unsyncs():
+    encoder = LedFrame.FrameEncoder()
+    decoder = create_decoder()
+    decoder.decode(encoder.encode(frame(0)))
+    rgb = frame(0)
+    rgb[3] = 9
+    payload = encoder.encode(rgb)
+    with pytest.raises(ValueError):
+        decoder.decode(payload[:-1])
+    assert not decoder.synced
+    assert decoder.frame_buffer[3].tolist() == [0, 0, 0]
@@ -0,0 +1,82 @@
+import pytest
+from Communication import OutboundQueue, create_outbound_queue, mqtt_client
+
+def test_full_queue_drops_oldest_message():
+    queue = OutboundQueue(size = 2)
+    for i in range(3):
+        queue.put("/t", {"i": i}, str(i))
+    assert queue.dropped == 1
+    assert queue.pop() == ("/t", "1", False)
+    assert queue.pop() == ("/t", "2", False)
+    assert queue.pop() is None
+
+def test_topic_conflation_keeps_newest_message():
+    queue = OutboundQueue(size = 4, conflate = "topic")
+    queue.put("/a", None, "a1")
+    queue.put("/b", None, "b1")
+    queue.put("/a", None, "a2", retain = True)
+    assert queue.conflated == 1
+    # The replaced message keeps its position
+    assert queue.pop() == ("/a", "a2", True)
+    assert queue.pop() == ("/b", "b1", False)
+
+def test_field_conflation():
+    queue = OutboundQueue(size = 10, conflate = "id")
+    for rgb in [0, 1]:
+        for i in range(3):
+            queue.put("/rgb", {"id": i, "rgb": rgb}, str((i, rgb)))
+    # Messages without the field are queued as they are
+    queue.put("/rgb", {"other": 1}, "other")
+    queue.put("/rgb", {"other": 1}, "other")
+    assert queue.conflated == 3
+    assert queue.get_stats()["queued"] == 5
+    assert [queue.pop()[1] for _ in range(5)] == ["(0, 1)", "(1, 1)", "(2, 1)", "other", "other"]
+
+def test_clear_counts_queued_messages_as_dropped():
+    queue = OutboundQueue(max_inflight = 2, size = 3)
+    queue.inflight = 2
+    queue.put("/t", None, "1")
+    queue.clear()
+    assert queue.get_stats() == {"queued": 0, "inflight": 0, "sent": 0, "dropped": 1, "conflated": 0}
+
+def test_config_parsing():
+    queue = create_outbound_queue("max_inflight=4 queue=300 conflate=id")
+    assert (queue.max_inflight, queue.size, queue.conflate) == (4, 300, "id")
+    assert create_outbound_queue("").conflate is None
+    for config in ["queue=0", "queue=x", "limit=3", "conflate"]:
+        with pytest.raises(Exception):
+            create_outbound_queue(config)
+
+@pytest.fixture
+def comm(create_comm):
+    comm = create_comm("[Topics]\nframe = /frame\n[Codecs]\nframe = raw\n"
+                       "[Outbound]\nframe = max_inflight=1 queue=1 conflate=topic\n")
+    comm.on_connect(comm.client, None, {}, 0)
+    return comm
+
+def test_only_newest_frame_waits_for_slow_connection(comm):
+    for i in range(4):
+        assert comm.publish("frame", bytes([i]))
+    # The first frame is in flight, 1 and 2 have been replaced by 3
+    assert comm.client.published == [b"\x00"]
+    assert comm.get_outbound_losses("frame") == 2
+
+    comm.on_publish(comm.client, None, 1)
+    assert comm.client.published == [b"\x00", b"\x03"]
+    comm.on_publish(comm.client, None, 2)
+    assert comm.get_outbound_stats()["frame"] == {"queued": 0, "inflight": 0, "sent": 2, "dropped": 0, "conflated": 2}
+
+def test_messages_are_dropped_while_disconnected(comm):
+    comm.publish("frame", b"\x00")
+    comm.publish("frame", b"\x01")
+    comm.on_disconnect(comm.client, None, 7)
+    assert not comm.publish("frame", b"\x02")
+    # The queued message is stale after the reconnect
+    assert comm.get_outbound_stats()["frame"]["dropped"] == 2
+    assert comm.get_outbound_stats()["frame"]["inflight"] == 0
+
+def test_message_paho_refuses_is_dropped(comm):
+    comm.client.rc = mqtt_client.MQTT_ERR_NO_CONN
+    assert comm.publish("frame", b"\x00")
+    assert comm.get_outbound_stats()["frame"]["dropped"] == 1
+    assert comm.get_outbound_stats()["frame"]["inflight"] == 0
@@ -0,0 +1,214 @@
+import sys
+import threading
+import pytest
+import PowerControl
+from PowerControl import Transmitter
+
+# Transmitter, whose sends are recorded and can be held, to have a code in flight
+class RecordingTransmitter(Transmitter):
+    def send(self, code):
+        self.sending_code.set()
+        self.release.wait(5)
+        self.codes.append(code)
+        return code not in self.failing
+
+    def __init__(self, queue_size = 16, on_sent = None):
+        super().__init__("sender {code}", queue_size, on_sent)
+        self.codes = []
+        self.failing = set()
+        self.sending_code = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    # Starts sending the next code, but keeps it in flight until resume() is called
+    def hold(self):
+        self.release.clear()
+        self.sending_code.clear()
+
+    def resume(self):
+        self.release.set()
+
+@pytest.fixture
+def transmitter():
+    transmitter = RecordingTransmitter(queue_size = 3)
+    yield transmitter
+    transmitter.resume()
+    transmitter.stop()
+
+def test_codes_are_sent_in_order(transmitter):
+    sent = []
+    transmitter.on_sent = lambda outlet, code: sent.append((outlet, code))
+    transmitter.start()
+    transmitter.submit("A", 1)
+    transmitter.submit("B", 2)
+    assert transmitter.wait_idle(5)
+    assert sent == [("A", 1), ("B", 2)]
+    assert transmitter.sent == 2
+
+def test_pending_code_is_replaced_by_newer_one(transmitter):
+    transmitter.submit_batch([("A", 1), ("B", 2), ("A", 3)])
+    transmitter.start()
+    assert transmitter.wait_idle(5)
+    # A keeps its position in the queue, but only its latest code is sent
+    assert transmitter.codes == [3, 2]
+    assert transmitter.collapsed == 1
+
+def test_oldest_command_is_dropped_when_full(transmitter):
+    transmitter.submit_batch([("A", 1), ("B", 2), ("C", 3), ("D", 4)])
+    assert transmitter.dropped == 1
+    assert transmitter.get_submitted("A") is None
+    transmitter.start()
+    assert transmitter.wait_idle(5)
+    assert transmitter.codes == [2, 3, 4]
+
+def test_submitted_code_includes_code_in_flight(transmitter):
+    transmitter.start()
+    transmitter.hold()
+    transmitter.submit("A", 1)
+    assert transmitter.sending_code.wait(5)
+    assert not transmitter.is_pending("A")
+    assert transmitter.get_submitted("A") == 1
+    transmitter.resume()
+    assert transmitter.wait_idle(5)
+    assert transmitter.get_submitted("A") == 1
+
+def test_failed_code_is_forgotten(transmitter):
+    transmitter.failing.add(1)
+    transmitter.start()
+    transmitter.submit("A", 1)
+    assert transmitter.wait_idle(5)
+    assert transmitter.failed == 1
+    assert transmitter.get_submitted("A") is None
+
+def test_batch_without_replace_skips_outlets_on_their_way(transmitter):
+    transmitter.start()
+    transmitter.hold()
+    transmitter.submit("A", 1)
+    assert transmitter.sending_code.wait(5)
+    transmitter.submit("B", 2)
+    transmitter.submit_batch([("A", 10), ("B", 20), ("C", 30)], replace = False)
+    transmitter.resume()
+    assert transmitter.wait_idle(5)
+    assert transmitter.codes == [1, 2, 30]
+
+def test_stop_sends_queued_codes_first():
+    transmitter = RecordingTransmitter()
+    transmitter.start()
+    transmitter.submit_batch([("A", 1), ("B", 2)])
+    transmitter.stop()
+    assert transmitter.codes == [1, 2]
+
+def test_sender_runs_without_shell(tmp_path):
+    out = tmp_path / "sent"
+    transmitter = Transmitter(sys.executable + " -c \"import sys; open(sys.argv[1], 'w').write(sys.argv[2])\" "
+                              + str(out) + " {code};true")
+    assert transmitter.send(1234)
+    # The ; is passed on as part of the argument instead of separating shell commands
+    assert out.read_text() == "1234;true"
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        Transmitter(queue_size = 0)
+    with pytest.raises(ValueError):
+        Transmitter("")
+
+# Stand-in for Comm, recording published messages
+class FakeComm:
+    def __init__(self, client_id):
+        self.connected = True
+        self.published = []
+        self.connect_callbacks = []
+
+    def wait_connected(self, timeout = None):
+        return True
+
+    def subscribe(self, topicId, callback):
+        pass
+
+    def add_connect_callback(self, callback):
+        self.connect_callbacks.append(callback)
+        callback()
+
+    def reconnect(self):
+        self.connected = True
+        for callback in self.connect_callbacks:
+            callback()
+
+    def publish(self, topicId, msg, levels = None, retain = False):
+        if not self.connected:
+            return False
+        self.published.append((topicId, msg["id"], msg["val"], retain))
+        return True
+
+@pytest.fixture
+def power_control(tmp_path, monkeypatch):
+    monkeypatch.setattr(PowerControl, "Comm", FakeComm)
+    monkeypatch.setattr(PowerControl, "Transmitter",
+                        lambda sender, queue_size, on_sent: RecordingTransmitter(queue_size, on_sent))
+    (tmp_path / "radio_codes.cfg").write_text("[A]\non = 11\noff = 10\n[B]\non = 21\noff = 20\n")
+    (tmp_path / "outlets.cfg").write_text("[Outlets]\nbaum = A\nfountain = B\n")
+    pc = PowerControl.PowerControl(str(tmp_path / "radio_codes.cfg"), str(tmp_path / "outlets.cfg"),
+                                   state_file = str(tmp_path / "power_state.json"))
+    yield pc
+    pc.transmitter.resume()
+    pc.transmitter.stop()
+
+def request(pc, outlet_id, state):
+    pc.handleRequest({"id": outlet_id, "val": state})
+
+def test_repeated_request_is_skipped(power_control):
+    request(power_control, "baum", "on")
+    assert power_control.transmitter.wait_idle(5)
+    request(power_control, "baum", "on")
+    assert power_control.transmitter.wait_idle(5)
+    assert power_control.transmitter.codes == ["11"]
+    assert power_control.skipped == 1
+    assert power_control.states.get("A") == "on"
+
+def test_request_is_compared_with_code_in_flight(power_control):
+    transmitter = power_control.transmitter
+    request(power_control, "baum", "on")
+    assert transmitter.wait_idle(5)
+
+    # While off is being sent, the outlet is still on. Switching it on again must not be skipped
+    transmitter.hold()
+    request(power_control, "baum", "off")
+    assert transmitter.sending_code.wait(5)
+    request(power_control, "baum", "on")
+    transmitter.resume()
+    assert transmitter.wait_idle(5)
+    assert transmitter.codes == ["11", "10", "11"]
+    assert power_control.states.get("A") == "on"
+    assert power_control.skipped == 0
+
+def test_refresh_does_not_override_pending_request(power_control):
+    transmitter = power_control.transmitter
+    request(power_control, "fountain", "on")
+    request(power_control, "baum", "on")
+    assert transmitter.wait_idle(5)
+
+    transmitter.hold()
+    request(power_control, "baum", "off")
+    assert transmitter.sending_code.wait(5)
+    request(power_control, "fountain", "off")
+    power_control.refresh()
+    transmitter.resume()
+    assert transmitter.wait_idle(5)
+    assert transmitter.codes == ["21", "11", "10", "20"]
+    assert power_control.states.get("B") == "off"
+
+def test_states_survive_restart(power_control, tmp_path):
+    request(power_control, "fountain", "on")
+    assert power_control.transmitter.wait_idle(5)
+    restored = PowerControl.OutletStates(str(tmp_path / "power_state.json"))
+    assert restored.get("B") == "on"
+
+def test_states_are_republished_after_reconnect(power_control):
+    comm = power_control.comm
+    comm.connected = False
+    request(power_control, "fountain", "on")
+    assert power_control.transmitter.wait_idle(5)
+    assert comm.published == []
+
+    comm.reconnect()
+    assert comm.published == [("power_state", "fountain", "on", True)]
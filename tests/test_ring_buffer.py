@@ -0,0 +1,90 @@
+import threading
+import time
+import numpy as np
+import pytest
+from RingBuffer import RingBuffer
+
+def samples(start, count):
+    return np.arange(start, start + count, dtype=np.float32)
+
+def test_reads_newest_window():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 5))
+    assert ring.available() == 5
+    assert ring.read_latest(3).tolist() == [2, 3, 4]
+    assert ring.available() == 0
+    assert ring.overflows == 2
+    assert ring.underruns == 0
+
+def test_read_across_wrap_point():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 6))
+    ring.read_latest(6)
+    ring.write(samples(6, 5))
+    out = np.zeros(5, dtype=np.float32)
+    assert ring.read_latest(5, out) is out
+    assert out.tolist() == [6, 7, 8, 9, 10]
+    assert ring.overflows == 0
+
+def test_write_larger_than_capacity_keeps_newest_samples():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 3))
+    ring.write(samples(3, 20))
+    assert ring.written == 23
+    assert ring.read_latest(8).tolist() == list(range(15, 23))
+    # Everything before the window is lost
+    assert ring.overflows == 15
+
+def test_read_before_window_is_recorded_pads_with_silence():
+    ring = RingBuffer(8)
+    ring.write(samples(1, 3))
+    assert ring.read_latest(5).tolist() == [0, 0, 1, 2, 3]
+    assert ring.underruns == 1
+    assert ring.available() == 0
+
+def test_overflows_when_reader_falls_behind():
+    ring = RingBuffer(16)
+    ring.write(samples(0, 4))
+    ring.read_latest(4)
+    ring.write(samples(4, 10))
+    assert ring.read_latest(4).tolist() == [10, 11, 12, 13]
+    assert ring.overflows == 6
+
+def test_read_larger_than_capacity_raises():
+    with pytest.raises(ValueError):
+        RingBuffer(8).read_latest(9)
+
+def test_wait_times_out_and_counts_underrun():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 2))
+    start = time.time()
+    assert not ring.wait(4, timeout = 0.05)
+    assert time.time() - start >= 0.05
+    assert ring.underruns == 1
+
+def test_wait_returns_once_producer_has_written():
+    ring = RingBuffer(8)
+    writer = threading.Timer(0.05, ring.write, args=(samples(0, 4),))
+    writer.start()
+    assert ring.wait(4, timeout = 5)
+    writer.join()
+    assert ring.underruns == 0
+
+# Buffer, which lets the producer write once while the consumer is copying from it
+class InterruptedBuffer(np.ndarray):
+    interrupt = None
+
+    def __getitem__(self, index):
+        interrupt = self.interrupt
+        if interrupt is not None:
+            self.interrupt = None
+            interrupt()
+        return super().__getitem__(index)
+
+def test_torn_read_is_retried():
+    ring = RingBuffer(8)
+    ring.write(samples(0, 8))
+    ring.buffer = ring.buffer.view(InterruptedBuffer)
+    # Overwrites the window while it is being copied
+    ring.buffer.interrupt = lambda: ring.write(samples(8, 6))
+    assert ring.read_latest(4).tolist() == [10, 11, 12, 13]
@@ -0,0 +1,60 @@
+import multiprocessing
+import numpy as np
+import pytest
+from RingBuffer import SharedRing
+
+@pytest.fixture
+def ring():
+    ring = SharedRing((4,), np.float32, slots = 4)
+    yield ring
+    ring.release()
+
+def test_reads_newest_record_and_counts_overruns(ring):
+    out = np.zeros(4, dtype=np.float32)
+    assert ring.read_latest(out) is None
+    for i in range(6):
+        ring.write(np.full(4, i), timestamp = i / 10)
+    assert ring.available()
+    assert ring.read_latest(out) == (5, 0.5)
+    assert out.tolist() == [5, 5, 5, 5]
+    assert ring.overruns == 5
+    assert not ring.available()
+    assert ring.read_latest(out) is None
+
+def test_wait_returns_on_close(ring):
+    assert not ring.wait(0.01)
+    ring.close_writer()
+    assert ring.is_closed()
+    assert not ring.wait(1)
+
+def test_invalid_slots():
+    with pytest.raises(ValueError):
+        SharedRing((4,), np.float32, slots = 1)
+
+def produce(ring, count):
+    for i in range(count):
+        ring.write(np.full(ring.shape, i % 256), float(i))
+        ring.notify()
+    ring.close_writer()
+
+# Reads from a producer process, checking that no record is torn
+def test_records_from_other_process_are_never_torn():
+    ring = SharedRing((64, 3), np.uint8, slots = 2)
+    out = np.zeros((64, 3), dtype=np.uint8)
+    producer = multiprocessing.Process(target=produce, args=(ring, 20000))
+    try:
+        producer.start()
+        reads = 0
+        last_seq = -1
+        while ring.wait(5):
+            (seq, timestamp) = ring.read_latest(out)
+            assert seq > last_seq
+            assert timestamp == seq
+            assert np.all(out == seq % 256)
+            last_seq = seq
+            reads += 1
+        producer.join(5)
+    finally:
+        ring.release()
+    assert last_seq == 19999
+    assert reads + ring.overruns == 20000
@@ -0,0 +1,89 @@
+import json
+import pytest
+from Communication import TopicTrie, fill_topic
+
+def matches(trie, topic):
+    return sorted(trie.match(topic))
+
+@pytest.fixture
+def trie():
+    trie = TopicTrie()
+    for topic_filter in ["/led/request", "/led/+/request", "/led/#", "+/+/+", "#", "a/b", "a/#"]:
+        trie.add(topic_filter, topic_filter)
+    return trie
+
+def test_exact_topic(trie):
+    assert matches(trie, "a/b") == ["#", "a/#", "a/b"]
+    assert matches(trie, "x/y") == ["#"]
+
+def test_single_level_wildcard(trie):
+    assert matches(trie, "/led/strip1/request") == ["#", "/led/#", "/led/+/request"]
+    # + matches exactly one level
+    assert "/led/+/request" not in trie.match("/led/a/b/request")
+    assert "/led/+/request" not in trie.match("/led/request")
+
+def test_multi_level_wildcard_matches_parent_level(trie):
+    assert "a/#" in trie.match("a")
+    assert "a/#" in trie.match("a/b/c/d")
+    assert "a/#" not in trie.match("ab")
+
+def test_empty_levels_are_levels(trie):
+    # /led/request has the empty first level "", so +/+/+ matches it
+    assert matches(trie, "/led/request") == ["#", "+/+/+", "/led/#", "/led/request"]
+
+def test_dollar_topics_are_not_matched_by_leading_wildcards(trie):
+    assert trie.match("$SYS/broker/load") == []
+    trie.add("$SYS/#", "sys")
+    assert trie.match("$SYS/broker/load") == ["sys"]
+
+@pytest.mark.parametrize("topic_filter", ["a/#/b", "a/b#", "a/+b", "a+/b"])
+def test_invalid_filters(topic_filter):
+    with pytest.raises(Exception):
+        TopicTrie().add(topic_filter, None)
+
+def test_fill_topic():
+    assert fill_topic("/power/state/+", ["fountain"]) == "/power/state/fountain"
+    assert fill_topic("/+/x/+", [1, 2]) == "/1/x/2"
+    with pytest.raises(Exception):
+        fill_topic("/power/state/+", [])
+    with pytest.raises(Exception):
+        fill_topic("/power/state/+", ["a", "b"])
+    with pytest.raises(Exception):
+        fill_topic("/power/#", ["a"])
+
+class Message:
+    def __init__(self, topic, msg):
+        self.topic = topic
+        self.payload = json.dumps(msg).encode()
+
+@pytest.fixture
+def comm(create_comm):
+    return create_comm("[Topics]\nled_request = /led/+/request\nall = /led/#\n")
+
+def test_subscriptions_are_sent_on_connect_and_renewed_on_reconnect(comm):
+    comm.subscribe("led_request", lambda msg: None)
+    assert comm.client.subscribed == []
+
+    comm.on_connect(comm.client, None, {}, 0)
+    assert comm.client.subscribed == ["/led/+/request"]
+
+    comm.on_disconnect(comm.client, None, 7)
+    comm.on_connect(comm.client, None, {}, 0)
+    assert comm.client.subscribed == ["/led/+/request", "/led/+/request"]
+
+def test_received_messages_reach_all_matching_callbacks(comm):
+    received = []
+    comm.subscribe("led_request", lambda msg: received.append(("first", msg)))
+    comm.subscribe("led_request", lambda msg, topic: received.append(("second", topic)), with_topic = True)
+    comm.subscribe("all", lambda msg: received.append(("all", msg)))
+    comm.on_connect(comm.client, None, {}, 0)
+    # A second callback for a topic reuses its subscription
+    assert comm.client.subscribed == ["/led/+/request", "/led/#"]
+
+    comm.on_message(comm.client, None, Message("/led/strip1/request", {"id": "led_power"}))
+    assert sorted(received, key=str) == [("all", {"id": "led_power"}), ("first", {"id": "led_power"}),
+                                         ("second", "/led/strip1/request")]
+
+    received.clear()
+    comm.on_message(comm.client, None, Message("/led/strip1/status", {}))
+    assert received == [("all", {})]